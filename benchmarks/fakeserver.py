@@ -0,0 +1,352 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A stand-in for Zandronum servers that answers launcher queries and RCON like
+# the real thing does, so the query and RCON code can be tested and load tested
+# without any binaries
+# - A FakeServerFleet runs any number of FakeServers on one thread, replies are
+# delayed by the latency (plus up to jitter) and any datagram is dropped with
+# the chance in loss
+# Run with: python -m benchmarks.fakeserver [first port] [count] [rcon password]
+
+import hashlib
+import heapq
+import os
+import random
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+import net.huffman
+import net.rcon
+import net.serverquery
+from benchmarks.payloads import PLAYER_NAMES
+
+# How many lines of the log the RCON login reply carries, like Zandronum
+LOGGEDIN_LOG_LINES = 10
+
+# How long an RCON client can go without a pong before it's forgotten (seconds)
+RCON_CLIENT_TIMEOUT = 10.0
+
+
+# One fake Zandronum server bound to a UDP port
+class FakeServer:
+    def __init__(self, port, ip='127.0.0.1', numplayers=8, rconpass='rconpassword', mapname='MAP01',
+                 latency=0.0, jitter=0.0, loss=0.0, seed=None):
+        self.port = port
+        self.numplayers = numplayers
+        self.rconpass = rconpass
+        self.mapname = mapname
+        self.hostname = 'Fake Zandronum Server :{}'.format(port)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rng = random.Random(None if seed is None else (seed << 16) + port)  # Every port gets its own sequence
+        self.players = ['{}{}'.format(self.rng.choice(PLAYER_NAMES), i) for i in range(numplayers)]
+        self.log = []
+        self.commands = []
+        self.queries_answered = 0
+        self.rcon_clients = {}  # Address -> [salt, logged in, last heard from]
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.socket.bind((ip, port))
+
+    def close(self):
+        self.socket.close()
+
+    # Acts like the server was restarted on the same port: every RCON client
+    # is forgotten, without telling them
+    def restart(self):
+        self.rcon_clients = {}
+        self.log = []
+        self.commands = []
+
+    # Handles a datagram, returns the (decoded) datagrams to send back as a list
+    # of (datagram, address)
+    def handle(self, data, address):
+        decodeddata = net.huffman.decode(data)
+        if len(decodeddata) >= 12 and struct.unpack_from('<l', decodeddata)[0] == net.serverquery.LAUNCHER_CHALLENGE:
+            self.queries_answered += 1
+            return [(self.make_query_reply(struct.unpack_from('<L', decodeddata, 4)[0]), address)]
+        if not decodeddata:
+            return []
+        header = decodeddata[0]
+        if header == net.rcon.CLRC_BEGINCONNECTION:
+            if len(decodeddata) < 2 or decodeddata[1] != net.rcon.ZAN_PROTOCOL_VERSION:
+                return [(bytes((net.rcon.SVRC_OLDPROTOCOL,)), address)]
+            salt = '{:032X}'.format(self.rng.getrandbits(128)).encode('ascii')
+            self.rcon_clients[address] = [salt, False, time.monotonic()]
+            return [(bytes((net.rcon.SVRC_SALT,)) + salt + b'\0', address)]
+        client = self.rcon_clients.get(address)
+        if client is None:
+            return []
+        client[2] = time.monotonic()
+        if header == net.rcon.CLRC_PASSWORD:
+            expected = hashlib.md5(client[0] + self.rconpass.encode('ascii')).hexdigest().encode('ascii')
+            if decodeddata[1:].rstrip(b'\0').lower() != expected:
+                del self.rcon_clients[address]
+                return [(bytes((net.rcon.SVRC_INVALIDPASSWORD,)), address)]
+            client[1] = True
+            return [(self.make_loggedin_reply(), address)]
+        if not client[1]:
+            return []
+        if header == net.rcon.CLRC_COMMAND:
+            return self.run_command(decodeddata[1:].rstrip(b'\0').decode('latin1'))
+        if header == net.rcon.CLRC_DISCONNECT:
+            del self.rcon_clients[address]
+        return []
+
+    # Runs an RCON command, only the ones that change what a query returns do
+    # anything. Like Zandronum, the console output and any updates go to every
+    # logged in RCON client
+    def run_command(self, command):
+        self.commands.append(command)
+        words = command.split()
+        updates = []
+        if len(words) > 1 and words[0].lower() in ('map', 'changemap'):
+            self.mapname = words[1].upper()
+            updates.append(bytes((net.rcon.SVRC_UPDATE, net.rcon.SVRCU_MAP)) + self.mapname.encode('latin1') + b'\0')
+        elif len(words) > 1 and words[0].lower() == 'sv_hostname':
+            self.hostname = command.split(None, 1)[1]
+        elif len(words) > 1 and words[0].lower() == 'kick' and words[1] in self.players:
+            self.players.remove(words[1])
+            update = bytearray((net.rcon.SVRC_UPDATE, net.rcon.SVRCU_PLAYERDATA, len(self.players)))
+            for name in self.players:
+                update.extend(name.encode('latin1') + b'\0')
+            updates.append(bytes(update))
+        message = '-> {}'.format(command)
+        self.log.append(message)
+        updates.insert(0, bytes((net.rcon.SVRC_MESSAGE,)) + message.encode('latin1') + b'\0')
+        return [(update, address) for address, client in self.rcon_clients.items() if client[1] for update in updates]
+
+    # The login reply: protocol version, hostname, every update, then the end of the log
+    def make_loggedin_reply(self):
+        reply = bytearray((net.rcon.SVRC_LOGGEDIN, net.rcon.ZAN_PROTOCOL_VERSION))
+        reply.extend(self.hostname.encode('latin1') + b'\0')
+        reply.append(3)
+        reply.extend((net.rcon.SVRCU_PLAYERDATA, len(self.players)))
+        for name in self.players:
+            reply.extend(name.encode('latin1') + b'\0')
+        reply.extend((net.rcon.SVRCU_ADMINCOUNT, len(self.rcon_clients)))
+        reply.append(net.rcon.SVRCU_MAP)
+        reply.extend(self.mapname.encode('latin1') + b'\0')
+        lines = self.log[-LOGGEDIN_LOG_LINES:]
+        reply.append(len(lines))
+        for line in lines:
+            reply.extend(line.encode('latin1') + b'\0')
+        return bytes(reply)
+
+    # The launcher reply with the fields that were asked for
+    def make_query_reply(self, flags):
+        sq = net.serverquery
+        flags &= sq.SQF_MAPNAME | sq.SQF_NAME | sq.SQF_MAXCLIENTS | sq.SQF_MAXPLAYERS | sq.SQF_PWADS | \
+            sq.SQF_GAMETYPE | sq.SQF_GAMENAME | sq.SQF_IWAD | sq.SQF_GAMESKILL | sq.SQF_BOTSKILL | sq.SQF_LIMITS | \
+            sq.SQF_TEAMDAMAGE | sq.SQF_NUMPLAYERS | sq.SQF_PLAYERDATA | sq.SQF_TEAMINFO_NUMBER | \
+            sq.SQF_TEAMINFO_NAME | sq.SQF_TEAMINFO_COLOR | sq.SQF_TEAMINFO_SCORE | sq.SQF_ALL_DMFLAGS
+        reply = bytearray(struct.pack('<ll', 5660023, int(time.time())))
+        reply.extend(b'2.0 (r140331-1503) on Linux 3.13.0\0')
+        reply.extend(struct.pack('<l', flags))
+        if flags & sq.SQF_NAME:
+            reply.extend(self.hostname.encode('latin1') + b'\0')
+        if flags & sq.SQF_MAPNAME:
+            reply.extend(self.mapname.encode('latin1') + b'\0')
+        if flags & sq.SQF_MAXCLIENTS:
+            reply.append(32)
+        if flags & sq.SQF_MAXPLAYERS:
+            reply.append(32)
+        if flags & sq.SQF_PWADS:
+            reply.extend(b'\x02zdoom-dm-maps.wad\0skulltag_data_126.pk3\0')
+        if flags & sq.SQF_GAMETYPE:
+            reply.extend((sq.GAMEMODE_TEAMPLAY, 0, 0))
+        if flags & sq.SQF_GAMENAME:
+            reply.extend(b'DOOM II\0')
+        if flags & sq.SQF_IWAD:
+            reply.extend(b'doom2.wad\0')
+        if flags & sq.SQF_GAMESKILL:
+            reply.append(3)
+        if flags & sq.SQF_BOTSKILL:
+            reply.append(3)
+        if flags & sq.SQF_LIMITS:
+            reply.extend(struct.pack('<HHHHHH', 50, 20, 12, 0, 0, 0))  # Time left since there's a time limit
+        if flags & sq.SQF_TEAMDAMAGE:
+            reply.extend(struct.pack('<f', 0.0))
+        if flags & sq.SQF_NUMPLAYERS:
+            reply.append(len(self.players))
+        if flags & sq.SQF_PLAYERDATA:
+            for i, name in enumerate(self.players):
+                reply.extend(name.encode('latin1') + b'\0')
+                reply.extend(struct.pack('<hhBBBB', self.rng.randint(0, 50), self.rng.randint(10, 200), 0, 0, i & 1,
+                                         self.rng.randint(0, 120)))
+        if flags & sq.SQF_TEAMINFO_NUMBER:
+            reply.append(2)
+        if flags & (sq.SQF_TEAMINFO_NAME | sq.SQF_TEAMINFO_COLOR | sq.SQF_TEAMINFO_SCORE):
+            for name, color in ((b'Blue', 0x0000FF), (b'Red', 0xFF0000)):
+                if flags & sq.SQF_TEAMINFO_NAME:
+                    reply.extend(name + b'\0')
+                if flags & sq.SQF_TEAMINFO_COLOR:
+                    reply.extend(struct.pack('<l', color))
+                if flags & sq.SQF_TEAMINFO_SCORE:
+                    reply.extend(struct.pack('<h', self.rng.randint(0, 10)))
+        if flags & sq.SQF_ALL_DMFLAGS:
+            reply.append(5)
+            reply.extend(struct.pack('<lllll', 0, 0, 0, 0, 0))
+        return bytes(reply)
+
+    # Forgets the RCON clients that stopped sending pongs
+    def prune_rcon_clients(self):
+        deadline = time.monotonic() - RCON_CLIENT_TIMEOUT
+        for address in [address for address, client in self.rcon_clients.items() if client[2] < deadline]:
+            del self.rcon_clients[address]
+
+
+# Runs a group of FakeServers on a single thread
+class FakeServerFleet:
+    def __init__(self):
+        self.servers = []
+        self._selector = selectors.DefaultSelector()
+        self._outgoing = []  # Heap of (send time, sequence, server, datagram, address)
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._unregistered = []  # Servers the fleet thread still has to start listening on
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._wakeup_read.setblocking(False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+        self._running = False
+        self._thread = None
+
+    # Starts a FakeServer on every port that can be bound, returns the servers
+    # - The keyword arguments are passed on to every FakeServer
+    def add_servers(self, ports, **kwargs):
+        added = []
+        for port in ports:
+            try:
+                server = FakeServer(port, **kwargs)
+            except OSError as e:
+                print("Could not start a fake server on port", port, ":", e)
+                continue
+            with self._lock:
+                self.servers.append(server)
+                self._unregistered.append(server)
+            added.append(server)
+        self._wake()
+        return added
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake()
+        if self._thread is not None:
+            self._thread.join()
+        for server in self.servers:
+            server.close()
+        self.servers = []
+        self._selector.close()
+        self._wakeup_read.close()
+        self._wakeup_write.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _wake(self):
+        try:
+            self._wakeup_write.send(b'\0')
+        except OSError:
+            pass
+
+    def _run(self):
+        lastprune = time.monotonic()
+        while self._running:
+            timeout = 1.0
+            if self._outgoing:
+                timeout = max(0.0, self._outgoing[0][0] - time.monotonic())
+            with self._lock:
+                unregistered, self._unregistered = self._unregistered, []
+            for server in unregistered:
+                self._selector.register(server.socket, selectors.EVENT_READ, server)
+            events = self._selector.select(timeout)
+            for key, mask in events:
+                if key.data is None:
+                    try:
+                        self._wakeup_read.recv(4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._receive(key.data)
+            self._send_due()
+            if time.monotonic() - lastprune > RCON_CLIENT_TIMEOUT:
+                lastprune = time.monotonic()
+                for server in self.servers:
+                    server.prune_rcon_clients()
+
+    def _receive(self, server):
+        while True:
+            try:
+                data, address = server.socket.recvfrom(4096)
+            except (BlockingIOError, ConnectionError):
+                return
+            if server.loss and server.rng.random() < server.loss:
+                continue
+            for reply, address in server.handle(data, address):
+                delay = server.latency + (server.rng.random() * server.jitter if server.jitter else 0.0)
+                if delay <= 0:
+                    self._send(server, reply, address)
+                else:
+                    self._sequence += 1
+                    heapq.heappush(self._outgoing, (time.monotonic() + delay, self._sequence, server, reply, address))
+
+    def _send_due(self):
+        now = time.monotonic()
+        while self._outgoing and self._outgoing[0][0] <= now:
+            sendtime, sequence, server, reply, address = heapq.heappop(self._outgoing)
+            self._send(server, reply, address)
+
+    def _send(self, server, reply, address):
+        if server.loss and server.rng.random() < server.loss:
+            return
+        try:
+            server.socket.sendto(net.huffman.encode(reply), address)
+        except OSError:
+            pass
+
+
+def main(args):
+    firstport = int(args[1]) if len(args) > 1 else 10000
+    count = int(args[2]) if len(args) > 2 else 1
+    rconpass = args[3] if len(args) > 3 else 'rconpassword'
+    with FakeServerFleet() as fleet:
+        servers = fleet.add_servers(range(firstport, firstport + count), rconpass=rconpass,
+                                    seed=int.from_bytes(os.urandom(4), 'little'))
+        print("Running {} fake servers from port {}, ctrl+c to stop".format(len(servers), firstport))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
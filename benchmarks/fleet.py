@@ -0,0 +1,152 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Puts a fake server on every port from min_port to max_port in config.json and
+# measures how fast we can query and RCON all of them, with the tail latency
+# Run with: python -m benchmarks.fleet [latency] [loss] [players] [threads]
+
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import json
+import sys
+import time
+import net.rcon
+import net.serverpoller
+import net.serverquery
+from benchmarks.fakeserver import FakeServerFleet
+
+# Where the port range comes from
+CONFIG_FILE = 'config.json'
+
+# The address the fake servers listen on
+FLEET_IP = '127.0.0.1'
+
+# The password every fake server uses
+RCON_PASSWORD = 'benchmark'
+
+
+# Returns the value at the percentile (0-100) of a sorted list
+def percentile(sortedvalues, percent):
+    if not sortedvalues:
+        return 0.0
+    return sortedvalues[min(len(sortedvalues) - 1, int(len(sortedvalues) * percent / 100))]
+
+
+# Prints the throughput and the latency spread of a run
+def report(name, latencies, failures, elapsed):
+    latencies.sort()
+    total = len(latencies) + failures
+    print("{:<24} {:>6} ok {:>5} failed {:>9.1f}/s   p50 {:>7.2f}ms  p90 {:>7.2f}ms  p99 {:>7.2f}ms  max {:>7.2f}ms"
+          .format(name, len(latencies), failures, total / elapsed if elapsed else 0.0,
+                  percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+                  percentile(latencies, 99) * 1000, (latencies[-1] if latencies else 0.0) * 1000))
+
+
+# Runs the function on every port with a thread pool, timing each call
+# - A call fails if it returns None or False
+def run_threaded(function, ports, threads):
+    def timed(port):
+        start = time.perf_counter()
+        result = function(FLEET_IP, port)
+        return time.perf_counter() - start, result is not None and result is not False
+
+    latencies = []
+    failures = 0
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        for latency, ok in executor.map(timed, ports):
+            if ok:
+                latencies.append(latency)
+            else:
+                failures += 1
+    return latencies, failures, time.perf_counter() - start
+
+
+# Sweeps every port with the asyncio poller, which only gives the total time
+def run_sweep(ports, timeout, delta_tracker=None):
+    start = time.perf_counter()
+    results = asyncio.run(net.serverpoller.poll_servers([(FLEET_IP, port) for port in ports], timeout,
+                                                        net.serverpoller.DEFAULT_MAX_IN_FLIGHT, delta_tracker))
+    elapsed = time.perf_counter() - start
+    ok = sum(1 for result in results.values() if result is not None)
+    return ok, len(results) - ok, elapsed
+
+
+# Restarts some of the servers the pool is logged into and sends them a command,
+# which is lost since they forgot us. Once the sessions notice that it went
+# unanswered, they log in again for the next command. Returns how many of the
+# restarted servers got that one and how many were restarted
+def check_restart(pool, servers, threads):
+    restarted = servers[::max(1, len(servers) // 10)]
+    for server in restarted:
+        server.restart()
+    run_threaded(lambda ip, port: pool.send_command(ip, port, RCON_PASSWORD, 'say lost'),
+                 [server.port for server in restarted], threads)
+    time.sleep(net.rcon.RCON_TIMEOUT + 1.0)
+    run_threaded(lambda ip, port: pool.send_command(ip, port, RCON_PASSWORD, 'say restarted'),
+                 [server.port for server in restarted], threads)
+    # The commands are still on their way (or lost) when the sends return
+    deadline = time.monotonic() + net.rcon.RCON_TIMEOUT
+    while True:
+        received = sum(1 for server in restarted if 'say restarted' in server.commands)
+        if received == len(restarted) or time.monotonic() > deadline:
+            return received, len(restarted)
+        time.sleep(0.05)
+
+
+def main(args):
+    latency = float(args[1]) if len(args) > 1 else 0.0
+    loss = float(args[2]) if len(args) > 2 else 0.0
+    numplayers = int(args[3]) if len(args) > 3 else 8
+    threads = int(args[4]) if len(args) > 4 else 32
+    with open(CONFIG_FILE) as configfile:
+        settings = json.load(configfile)
+    ports = range(settings['zandronum']['min_port'], settings['zandronum']['max_port'] + 1)
+    with FakeServerFleet() as fleet:
+        servers = fleet.add_servers(ports, ip=FLEET_IP, numplayers=numplayers, rconpass=RCON_PASSWORD,
+                                    latency=latency, jitter=latency, loss=loss, seed=0)
+        ports = [server.port for server in servers]
+        print("{} fake servers, latency {}-{}ms, loss {:.0%}, {} players, {} threads".format(
+            len(ports), latency * 1000, latency * 2000, loss, numplayers, threads))
+        # The query and RCON functions print every timeout, which would drown out the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            queries = run_threaded(net.serverquery.perform_server_query, ports, threads)
+            commands = run_threaded(lambda ip, port: net.rcon.send_command(ip, port, RCON_PASSWORD, 'say benchmark'),
+                                    ports, threads)
+            pool = net.rcon.RCONSessionPool()
+            run_threaded(lambda ip, port: pool.send_command(ip, port, RCON_PASSWORD, 'say login'), ports, threads)
+            sessioncommands = run_threaded(lambda ip, port: pool.send_command(ip, port, RCON_PASSWORD, 'say benchmark'),
+                                           ports, threads)
+            restarted = check_restart(pool, servers, threads)
+            pool.close()
+            sweep = run_sweep(ports, settings['advanced']['query_timeout'])
+            tracker = net.serverquery.DeltaTracker(settings['advanced']['query_full_refresh_interval'])
+            run_sweep(ports, settings['advanced']['query_timeout'], tracker)
+            deltasweep = run_sweep(ports, settings['advanced']['query_timeout'], tracker)
+        report("query (threaded)", *queries)
+        report("rcon command (threaded)", *commands)
+        report("rcon command (session)", *sessioncommands)
+        print("{:<24} {:>6} of {} restarted servers got the command after logging in again".format(
+            "rcon session restart", *restarted))
+        for name, (ok, failures, elapsed) in (("query sweep", sweep), ("delta query sweep", deltasweep)):
+            print("{:<24} {:>6} ok {:>5} failed {:>9.1f}/s   total {:>7.2f}ms".format(
+                name, ok, failures, (ok + failures) / elapsed, elapsed * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,105 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures the throughput of the huffman codec on realistic packets
+# Run with: python -m benchmarks.huffman [seconds per measurement]
+
+import random
+import sys
+import time
+import net.huffman
+from benchmarks.payloads import PAYLOAD_MAKERS
+
+# How many different packets of each kind to cycle through
+PACKETS_PER_KIND = 64
+
+
+def encode_bitwise_all(packets):
+    for packet in packets:
+        net.huffman.encode_bitwise(packet)
+
+
+def encode_all(packets):
+    for packet in packets:
+        net.huffman.encode(packet)
+
+
+def encode_into_all(packets):
+    buffer = bytearray(8192)
+    for packet in packets:
+        net.huffman.encode_into(packet, buffer)
+
+
+def decode_bitwise_all(packets):
+    for packet in packets:
+        net.huffman.decode_bitwise(packet)
+
+
+def decode_all(packets):
+    for packet in packets:
+        net.huffman.decode(packet)
+
+
+def decode_into_all(packets):
+    buffer = bytearray(8192)
+    for packet in packets:
+        net.huffman.decode_into(packet, buffer)
+
+
+# The functions to measure, and whether they take decoded or encoded packets
+CODECS = (
+    ('encode_bitwise', encode_bitwise_all, False),
+    ('encode', encode_all, False),
+    ('encode_into', encode_into_all, False),
+    ('encode_batch', net.huffman.encode_batch, False),
+    ('decode_bitwise', decode_bitwise_all, True),
+    ('decode', decode_all, True),
+    ('decode_into', decode_into_all, True),
+    ('decode_batch', net.huffman.decode_batch, True),
+)
+
+
+# Runs the function over the packets for at least the given time, and returns
+# a tuple of (MB/s, packets/s) based on the size of the decoded packets
+# - The function is called once first without timing it, so building things
+# like the batch lookup tables isn't counted
+def measure(function, packets, rawbytes, seconds):
+    function(packets)
+    rounds = 0
+    start = time.perf_counter()
+    while True:
+        function(packets)
+        rounds += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return (rounds * rawbytes) / elapsed / 1000000, (rounds * len(packets)) / elapsed
+
+
+def main(args):
+    seconds = float(args[1]) if len(args) > 1 else 0.5
+    rng = random.Random(0)
+    print("{:<26} {:<16} {:>9} {:>12}".format("packet", "function", "MB/s", "packets/s"))
+    for name, maker in PAYLOAD_MAKERS:
+        rawpackets = [maker(rng) for i in range(PACKETS_PER_KIND)]
+        encodedpackets = [net.huffman.encode(packet) for packet in rawpackets]
+        rawbytes = sum(len(packet) for packet in rawpackets)
+        for functionname, function, takes_encoded in CODECS:
+            megabytes, packets = measure(function, encodedpackets if takes_encoded else rawpackets, rawbytes, seconds)
+            print("{:<26} {:<16} {:>9.2f} {:>12.0f}".format(name, functionname, megabytes, packets))
+        print()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
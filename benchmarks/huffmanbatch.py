@@ -0,0 +1,74 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the batch huffman functions against encoding/decoding one packet at
+# a time for different batch sizes, so we can see where the batch path wins
+# Run with: python -m benchmarks.huffmanbatch
+
+import random
+import time
+import net.huffman
+from benchmarks.payloads import make_query_reply
+
+# The batch sizes to try
+BATCH_SIZES = (1, 8, 32, 128, 512, 1024, 2048, 4096)
+
+# How long to run each measurement for (seconds)
+MEASURE_TIME = 0.5
+
+
+# Runs the function repeatedly and returns how many calls per second it managed
+def calls_per_second(function, argument):
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        function(argument)
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= MEASURE_TIME:
+            return calls / elapsed
+
+
+def encode_each(packets):
+    return [net.huffman.encode(packet) for packet in packets]
+
+
+def decode_each(packets):
+    return [net.huffman.decode(packet) for packet in packets]
+
+
+def main():
+    if net.huffman.numpy is None:
+        print("NumPy is not installed, the batch functions will fall back to one packet at a time.")
+    # Always take the numpy path so the crossover point shows up
+    net.huffman.ENCODE_BATCH_MINIMUM = 0
+    net.huffman.DECODE_BATCH_MINIMUM = 0
+    rng = random.Random(0)
+    print("{:>6} {:>16} {:>16} {:>16} {:>16}".format("batch", "encode pkt/s", "encode_batch", "decode pkt/s", "decode_batch"))
+    for size in BATCH_SIZES:
+        rawpackets = [make_query_reply(rng) for i in range(size)]
+        encodedpackets = encode_each(rawpackets)
+        if net.huffman.encode_batch(rawpackets) != encodedpackets or net.huffman.decode_batch(encodedpackets) != rawpackets:
+            raise RuntimeError("Batch output does not match the per packet output")
+        print("{:>6} {:>16.0f} {:>16.0f} {:>16.0f} {:>16.0f}".format(
+            size,
+            calls_per_second(encode_each, rawpackets) * size,
+            calls_per_second(net.huffman.encode_batch, rawpackets) * size,
+            calls_per_second(decode_each, encodedpackets) * size,
+            calls_per_second(net.huffman.decode_batch, encodedpackets) * size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Differential fuzzer for the huffman codec
+# - Every encoder and decoder is checked against the bitwise tree implementations
+# (encode_bitwise/decode_bitwise), which are what matches Zandronum. Anything
+# new that replaces them should be added to ENCODERS/DECODERS and pass this.
+# Run with: python -m benchmarks.huffmanfuzz [iterations] [seed]
+
+import random
+import sys
+import net.huffman
+from benchmarks.payloads import PAYLOAD_MAKERS
+
+
+def encode_into(rawdata):
+    buffer = bytearray(len(rawdata) + 1)
+    return buffer[:net.huffman.encode_into(memoryview(rawdata), buffer)]
+
+
+def decode_into(encodeddata):
+    buffer = bytearray(net.huffman.max_decoded_length(encodeddata))
+    return buffer[:net.huffman.decode_into(memoryview(encodeddata), buffer)]
+
+
+# The encoders and decoders that have to match the reference, these take and
+# return a list of packets
+ENCODERS = (
+    ('encode', lambda packets: [net.huffman.encode(packet) for packet in packets]),
+    ('encode_into', lambda packets: [encode_into(packet) for packet in packets]),
+    ('encode_batch', net.huffman.encode_batch),
+)
+
+DECODERS = (
+    ('decode', lambda packets: [net.huffman.decode(packet) for packet in packets]),
+    ('decode_into', lambda packets: [decode_into(packet) for packet in packets]),
+    ('decode_batch', net.huffman.decode_batch),
+)
+
+
+# Makes a random packet, mixing completely random bytes, text heavy packets,
+# and the real packet kinds (sometimes with bytes flipped)
+def make_random_packet(rng):
+    kind = rng.randint(0, 4)
+    if kind == 0:
+        return bytes(rng.getrandbits(8) for i in range(rng.randint(0, 64)))
+    if kind == 1:
+        return bytes(rng.choice(b'\0 eatoinsMAP0123') for i in range(rng.randint(0, 600)))
+    if kind == 2:
+        # Short packets are where the 0xFF fallback gets decided
+        return bytes(rng.getrandbits(8) for i in range(rng.randint(0, 4)))
+    packet = bytearray(rng.choice(PAYLOAD_MAKERS)[1](rng))
+    if kind == 4 and packet:
+        for i in range(rng.randint(1, 4)):
+            packet[rng.randrange(len(packet))] = rng.getrandbits(8)
+    return bytes(packet)
+
+
+# Makes a random encoded packet that an encoder would never produce, to check
+# the decoders agree on garbage too
+def make_random_encoded_packet(rng):
+    return bytes((rng.choice((0, 1, 7, 8, 20, 0xFE, 0xFF, rng.getrandbits(8))),)) + \
+        bytes(rng.getrandbits(8) for i in range(rng.randint(0, 40)))
+
+
+# Runs one round of the fuzzer, returns a list of failure messages
+def fuzz_round(rng, batchsize):
+    failures = []
+    rawpackets = [make_random_packet(rng) for i in range(batchsize)]
+    expected = [net.huffman.encode_bitwise(packet) for packet in rawpackets]
+    for name, encoder in ENCODERS:
+        for rawdata, reference, result in zip(rawpackets, expected, encoder(rawpackets)):
+            if bytes(result) != bytes(reference):
+                failures.append("{} mismatch for {}".format(name, rawdata.hex()))
+
+    encodedpackets = expected + [make_random_encoded_packet(rng) for i in range(batchsize)]
+    rng.shuffle(encodedpackets)
+    expected = [net.huffman.decode_bitwise(packet) for packet in encodedpackets]
+    for name, decoder in DECODERS:
+        for encodeddata, reference, result in zip(encodedpackets, expected, decoder(encodedpackets)):
+            if bytes(result) != bytes(reference):
+                failures.append("{} mismatch for {}".format(name, encodeddata.hex()))
+    return failures
+
+
+def main(args):
+    iterations = int(args[1]) if len(args) > 1 else 200
+    seed = int(args[2]) if len(args) > 2 else random.randrange(1 << 32)
+    print("Fuzzing {} rounds with seed {}".format(iterations, seed))
+    # Make the batch functions take their numpy path even for small batches
+    net.huffman.ENCODE_BATCH_MINIMUM = 0
+    net.huffman.DECODE_BATCH_MINIMUM = 0
+    rng = random.Random(seed)
+    for iteration in range(iterations):
+        failures = fuzz_round(rng, rng.choice((1, 2, 16, 64)))
+        if failures:
+            for failure in failures[:10]:
+                print(failure)
+            print("Failed on round {} (seed {})".format(iteration, seed))
+            return 1
+    print("All codecs matched the reference.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
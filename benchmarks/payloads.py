@@ -0,0 +1,90 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Makes realistic (decoded) packets of the kinds we send to and receive from
+# Zandronum servers, for the benchmarks and the fuzzer
+
+import hashlib
+import struct
+import net.rcon
+import net.serverquery
+
+# Some names to pick from so the player data looks like the real thing
+PLAYER_NAMES = ('Player', 'DoomGuy', '\\cdBestEver', 'Marine', 'xX_Frag_Xx', '\\ciCyber\\cjDemon', 'unnamed')
+
+# Some maps to pick from
+MAP_NAMES = ('MAP01', 'MAP07', 'MAP29', 'E1M1', 'E4M2', 'CTF01', 'DUEL05')
+
+
+# The query the launcher sends out
+def make_launcher_challenge(rng):
+    return struct.pack("<LLL", net.serverquery.LAUNCHER_CHALLENGE, net.serverquery.SQF_DESIRED_FLAGS, rng.randint(0, 0xFFFFFFFF))
+
+
+# The packet that starts an RCON login
+def make_rcon_begin_connection(rng):
+    return bytes((net.rcon.CLRC_BEGINCONNECTION, net.rcon.ZAN_PROTOCOL_VERSION))
+
+
+# The hashed password packet sent after receiving the salt
+def make_rcon_password(rng):
+    salt = bytes(rng.choice(b'0123456789ABCDEF') for i in range(32))
+    return bytes((net.rcon.CLRC_PASSWORD,)) + hashlib.md5(salt + b'rconpassword').hexdigest().encode('ascii')
+
+
+# An RCON command
+def make_rcon_command(rng):
+    command = rng.choice(('map MAP{:02d}'.format(rng.randint(1, 32)), 'say Server restarting in 5 minutes',
+                          'kick "{}" Banned'.format(rng.choice(PLAYER_NAMES)), 'sv_maxclients 16', 'fraglimit 50'))
+    return bytes((net.rcon.CLRC_COMMAND,)) + command.encode('ascii')
+
+
+# A full server query reply with every field we ask for, plus player data
+def make_query_reply(rng, numplayers=None):
+    if numplayers is None:
+        numplayers = rng.randint(0, 16)
+    flags = net.serverquery.SQF_DESIRED_FLAGS | net.serverquery.SQF_NUMPLAYERS | net.serverquery.SQF_PLAYERDATA
+    data = bytearray(struct.pack("<ll", 5660023, rng.randint(0, 0x7FFFFFFF)))
+    data.extend(b'2.0 (r140331-1503) on Linux 3.13.0\0')
+    data.extend(struct.pack("<l", flags))
+    data.extend(rng.choice(MAP_NAMES).encode('latin1') + b'\0')
+    data.extend(bytes((32, 32)))  # Max clients and max players
+    data.append(2)
+    data.extend(b'zdoom-dm-maps.wad\0skulltag_data_126.pk3\0')
+    data.extend(bytes((rng.randint(0, 15), 0, 0)))  # Gamemode, instagib, buckshot
+    data.extend(b'DOOM II\0doom2.wad\0')
+    data.extend(bytes((3, 3)))  # Game skill and bot skill
+    data.extend(struct.pack("<HH", 50, 20))
+    data.extend(struct.pack("<HHHH", 12, 0, 0, 0))  # Time left since there's a time limit, then the other limits
+    data.extend(struct.pack("<f", 1.0))
+    data.append(numplayers)
+    for i in range(numplayers):
+        data.extend('{}{}'.format(rng.choice(PLAYER_NAMES), rng.randint(0, 99)).encode('latin1') + b'\0')
+        data.extend(struct.pack("<hhBBBB", rng.randint(-5, 200), rng.randint(10, 300), rng.randint(0, 1), 0,
+                                255, rng.randint(0, 120)))
+    data.append(5)
+    data.extend(struct.pack("<lllll", 0, 0, 0, 0, 0))
+    return bytes(data)
+
+
+# Every kind of packet, by name
+PAYLOAD_MAKERS = (
+    ('launcher challenge', make_launcher_challenge),
+    ('rcon begin connection', make_rcon_begin_connection),
+    ('rcon password', make_rcon_password),
+    ('rcon command', make_rcon_command),
+    ('query reply', make_query_reply),
+    ('query reply (32 players)', lambda rng: make_query_reply(rng, 32)),
+)
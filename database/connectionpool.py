@@ -0,0 +1,141 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import threading
+import time
+import pymysql
+
+# The defaults for the pool settings
+DEFAULT_MAX_CONNECTIONS = 8
+DEFAULT_MAX_IDLE = 300.0  # Idle connections older than this are closed (seconds)
+DEFAULT_HEALTH_CHECK_INTERVAL = 30.0  # Connections idle longer than this are pinged before use (seconds)
+DEFAULT_CHECKOUT_TIMEOUT = 10.0  # How long to wait for a connection when they're all in use (seconds)
+
+# Errors after which a connection can't be trusted any more
+BROKEN_CONNECTION_ERRORS = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
+
+
+# Keeps MySQL connections open to be used again, instead of opening a new one
+# (TCP and the auth handshake) for every query
+# - At most max_connections are open at once, checking one out when they're
+# all in use waits for one to be returned
+# - Idle connections are closed after max_idle, and pinged before they're
+# handed out if they've sat for longer than health_check_interval
+# - A connection that raised one of BROKEN_CONNECTION_ERRORS is closed
+# instead of being returned
+class ConnectionPool:
+    def __init__(self, connect, max_connections=DEFAULT_MAX_CONNECTIONS, max_idle=DEFAULT_MAX_IDLE,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL, checkout_timeout=DEFAULT_CHECKOUT_TIMEOUT):
+        self._connect = connect
+        self._max_idle = max_idle
+        self._health_check_interval = health_check_interval
+        self._checkout_timeout = checkout_timeout
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle = []  # (connection, when it was returned), the last one is the most recently used
+        self._closed = False
+
+    # Checks out a connection for the with block, and returns it afterwards
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self._checkout()
+        try:
+            yield connection
+        except BROKEN_CONNECTION_ERRORS:
+            self._discard(connection)
+            raise
+        except BaseException:
+            self._checkin(connection)
+            raise
+        else:
+            self._checkin(connection)
+
+    # Closes every idle connection, the ones checked out are closed when they're returned
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for connection, returned in idle:
+            _close_quietly(connection)
+
+    def _checkout(self):
+        if not self._slots.acquire(timeout=self._checkout_timeout):
+            raise ConnectionPoolExhaustedException("No MySQL connection was free after {} seconds"
+                                                   .format(self._checkout_timeout))
+        try:
+            while True:
+                with self._lock:
+                    if self._closed:
+                        raise ConnectionPoolExhaustedException("The MySQL connection pool is closed")
+                    stale = self._take_stale()
+                    entry = self._idle.pop() if self._idle else None
+                for connection in stale:
+                    _close_quietly(connection)
+                if entry is None:
+                    return self._connect()
+                connection, returned = entry
+                if time.monotonic() - returned < self._health_check_interval or _is_alive(connection):
+                    return connection
+                _close_quietly(connection)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _checkin(self, connection):
+        with self._lock:
+            if not self._closed:
+                self._idle.append((connection, time.monotonic()))
+                connection = None
+        if connection is not None:
+            _close_quietly(connection)
+        self._slots.release()
+
+    def _discard(self, connection):
+        _close_quietly(connection)
+        self._slots.release()
+
+    # Must hold the lock, takes the connections that have been idle too long
+    # out of the pool and returns them
+    def _take_stale(self):
+        now = time.monotonic()
+        # The oldest are at the front
+        count = 0
+        while count < len(self._idle) and now - self._idle[count][1] >= self._max_idle:
+            count += 1
+        stale = [connection for connection, returned in self._idle[:count]]
+        del self._idle[:count]
+        return stale
+
+
+# Checks if the server still answers on the connection
+def _is_alive(connection):
+    try:
+        connection.ping(reconnect=False)
+        return True
+    except BROKEN_CONNECTION_ERRORS:
+        return False
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except pymysql.err.Error:
+        pass
+
+
+# Raised when a connection can't be checked out
+class ConnectionPoolExhaustedException(Exception):
+    pass
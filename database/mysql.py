@@ -13,9 +13,17 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import pymysql
-import bcrypt
 from time import time
+from database import connectionpool, passwordhasher
+from output.printlogger import *
+
+# How many times a query is tried when the connection it got turns out to be broken
+QUERY_ATTEMPTS = 2
+
+# The columns of the servers table that update_servers can set
+SERVER_UPDATE_COLUMNS = ('port', 'online')
 
 
 # This class handles all database related information
@@ -26,72 +34,147 @@ class MySQL:
         self._username = doomhost.settings['mysql']['username']
         self._password = doomhost.settings['mysql']['password']
         self._database = doomhost.settings['mysql']['database']
+        self.pool = connectionpool.ConnectionPool(self.connect, doomhost.settings['mysql']['max_connections'],
+                                                  doomhost.settings['mysql']['max_idle'],
+                                                  doomhost.settings['mysql']['health_check_interval'])
+        # bcrypt is slow on purpose, so it runs on its own processes
+        self.passwords = passwordhasher.PasswordHasher(doomhost.settings['advanced']['bcrypt_workers'],
+                                                       doomhost.settings['advanced']['bcrypt_max_queue'])
 
     def connect(self):
         return pymysql.connect(host=self._hostname, user=self._username, passwd=self._password, db=self._database, autocommit=True)
 
+    # Checks that the database can be reached, raises pymysql.MySQLError if not
+    def ping(self):
+        self._run(lambda cursor: cursor.execute("SELECT 1"))
+
+    def close(self):
+        self.passwords.shutdown()
+        self.pool.close()
+
+    # Runs function(cursor) on a pooled connection and returns what it returns
+    # - If the connection turns out to be broken (the server restarted, or it
+    # timed out) it's thrown away and the function is run again on a new one
+    def _run(self, function, cursorclass=None):
+        for attempt in range(QUERY_ATTEMPTS):
+            try:
+                with self.pool.connection() as connection:
+                    with connection.cursor(cursorclass) as cursor:
+                        return function(cursor)
+            except connectionpool.BROKEN_CONNECTION_ERRORS as e:
+                if attempt + 1 == QUERY_ATTEMPTS:
+                    raise
+                log(LEVEL_WARNING, "MySQL connection lost, reconnecting: {}".format(e))
+
+    def _execute(self, query, args=None):
+        return self._run(lambda cursor: cursor.execute(query, args))
+
     # -------------------------------------------------------------------------------------------- #
     # ----------------------------------- User Functions ----------------------------------------- #
     # -------------------------------------------------------------------------------------------- #
 
+    # The password functions return a concurrent.futures.Future, and raise
+    # passwordhasher.PasswordQueueFullException if too many are waiting
+
+    # The future gives whether the password is right
     def check_login(self, username, password):
         user = self.get_user(username)
         if user is None:
-            return False
-        if bcrypt.hashpw(password.encode('utf-8'), user['password'].encode('utf-8')) != user['password'].encode('utf-8'):
-            return False
-        return True
-
+            future = concurrent.futures.Future()
+            future.set_result(False)
+            return future
+        return self.passwords.verify(password, user['password'])
 
     def create_user(self, username, password, email):
-        connection = self.connect()
-        cursor = connection.cursor()
-        return cursor.execute("INSERT INTO `login` (`username`, `password`, `email`, `level`, `activated`, `server_limit`, `remember_token`) \
-            VALUES (%s, %s, %s, 1, 0, 4, null)", (username, bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(14))))
+        def insert(hashed):
+            return self._execute("INSERT INTO `login` (`username`, `password`, `email`, `level`, `activated`, `server_limit`, `remember_token`) \
+                VALUES (%s, %s, %s, 1, 0, 4, null)", (username, hashed, email))
+        return _then(self.passwords.hash(password), insert)
 
     def update_server_limit(self, user_id, server_limit):
-        connection = self.connect()
-        cursor = connection.cursor()
-        return cursor.execute("UPDATE `login` SET `server_limit` = %s WHERE `id` = %s", (server_limit, user_id))
+        return self._execute("UPDATE `login` SET `server_limit` = %s WHERE `id` = %s", (server_limit, user_id))
 
     def update_password(self, user_id, password):
-        connection = self.connect()
-        cursor = connection.cursor()
-        return cursor.execute("UPDATE `login` SET `password` = %s WHERE `id` = %s",
-            ((bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(14)), user_id)))
+        def update(hashed):
+            return self._execute("UPDATE `login` SET `password` = %s WHERE `id` = %s", (hashed, user_id))
+        return _then(self.passwords.hash(password), update)
 
     def set_activated(self, user_id):
-        connection = self.connect()
-        cursor = connection.cursor()
-        return cursor.execute("UPDATE `login` SET `activated` = 1 WHERE `id` = %s", user_id)
+        return self._execute("UPDATE `login` SET `activated` = 1 WHERE `id` = %s", user_id)
 
     def get_user(self, username):
-        connection = self.connect()
-        cursor = connection.cursor(pymysql.cursors.DictCursor)
-        cursor.execute("SELECT `id`, `username`, `password`, `level`, `activated`, `server_limit` FROM `login` WHERE `username` = %s", username)
-        return cursor.fetchone()
+        def select(cursor):
+            cursor.execute("SELECT `id`, `username`, `password`, `level`, `activated`, `server_limit` FROM `login` WHERE `username` = %s", username)
+            return cursor.fetchone()
+        return self._run(select, pymysql.cursors.DictCursor)
 
     # -------------------------------------------------------------------------------------------- #
     # ----------------------------------- Server Functions --------------------------------------- #
     # -------------------------------------------------------------------------------------------- #
 
+    # The server and its wads go in as one transaction, so running it again
+    # after a lost connection can't leave half of it behind
     def add_server(self, user_id, unique_id, wads):
-        connection = self.connect()
-        cursor = connection.cursor()
-        if cursor.execute("INSERT INTO `servers` (`unique_id`, `user_id`, `time_started`, `online`, `listener`) VALUES (%s, %s, %s, 0, %s)",
-            (unique_id, user_id, time(), self.doomhost.settings['network']['listener_id'])):
-            insertion_id = cursor.lastrowid
-            for wad in wads:
-                cursor.execute("INSERT INTO `servers_wads` (`server_id`, `name`) VALUES (%s, %s)", (insertion_id, wad))
+        def insert(cursor):
+            cursor.connection.begin()
+            try:
+                if cursor.execute("INSERT INTO `servers` (`unique_id`, `user_id`, `time_started`, `online`, `listener`) VALUES (%s, %s, %s, 0, %s)",
+                    (unique_id, user_id, time(), self.doomhost.settings['network']['listener_id'])):
+                    insertion_id = cursor.lastrowid
+                    for wad in wads:
+                        cursor.execute("INSERT INTO `servers_wads` (`server_id`, `name`) VALUES (%s, %s)", (insertion_id, wad))
+                cursor.connection.commit()
+            except connectionpool.BROKEN_CONNECTION_ERRORS:
+                raise  # The connection is thrown away, which rolls it back
+            except BaseException:
+                cursor.connection.rollback()
+                raise
+        self._run(insert)
 
     def update_port(self, unique_id, port):
-        connection = self.connect()
-        cursor = connection.cursor()
-        return cursor.execute("UPDATE `servers` SET `port` = %s WHERE `unique_id` = %s", (port, unique_id))
-
-    # Toggles a server between online and offline
-    # This is used twice -- once when the server starts, and once when it stops
-    def toggle_online(self, unique_id):
-        connection = self.connect()
-        cursor = connection.cursor()
-        return cursor.execute("UPDATE `servers` SET `online` = (1 - `online`) WHERE `unique_id` = %s", unique_id)
+        return self.update_server(unique_id, port=port)
+
+    def set_online(self, unique_id, online):
+        return self.update_server(unique_id, online=1 if online else 0)
+
+    # Sets columns of the server's row, for example update_server(unique_id, port=10000, online=1)
+    def update_server(self, unique_id, **columns):
+        return self.update_servers([(unique_id, columns)])
+
+    # Takes a list of (unique id, {column: value}) and writes each server's
+    # columns with one UPDATE, all in one transaction
+    def update_servers(self, updates):
+        for unique_id, columns in updates:
+            for column in columns:
+                if column not in SERVER_UPDATE_COLUMNS:
+                    raise ValueError("Can't update the servers column {}".format(column))
+
+        def update(cursor):
+            cursor.connection.begin()
+            try:
+                for unique_id, columns in updates:
+                    names = sorted(columns)
+                    cursor.execute("UPDATE `servers` SET {} WHERE `unique_id` = %s".format(
+                        ", ".join("`{}` = %s".format(name) for name in names)),
+                        [columns[name] for name in names] + [unique_id])
+                cursor.connection.commit()
+            except connectionpool.BROKEN_CONNECTION_ERRORS:
+                raise  # The connection is thrown away, which rolls it back
+            except BaseException:
+                cursor.connection.rollback()
+                raise
+        self._run(update)
+
+
+# Returns a future that gives what the function returns when it's called with
+# the result of the first future, once that's done
+def _then(future, function):
+    chained = concurrent.futures.Future()
+
+    def call(done):
+        try:
+            chained.set_result(function(done.result()))
+        except Exception as e:
+            chained.set_exception(e)
+    future.add_done_callback(call)
+    return chained
@@ -0,0 +1,111 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+import bcrypt
+
+# The bcrypt cost new passwords are hashed with
+BCRYPT_ROUNDS = 14
+
+# How many verify times are kept for the latency metrics
+LATENCY_HISTORY = 1000
+
+
+# Runs in a worker process
+def _verify_password(password, hashed):
+    return bcrypt.hashpw(password.encode('utf-8'), hashed.encode('utf-8')) == hashed.encode('utf-8')
+
+
+# Runs in a worker process
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds))
+
+
+# Runs bcrypt on a pool of processes so it doesn't hold up the thread that
+# needs it, and more than one can run at once
+# - Everything returns a concurrent.futures.Future
+# - At most max_queue calls can be running or waiting at once, after that
+# PasswordQueueFullException is raised until some finish
+class PasswordHasher:
+    def __init__(self, workers=None, max_queue=64):
+        self._workers = workers or os.cpu_count() or 1
+        # Spawned processes don't inherit the state of our other threads
+        self._executor = concurrent.futures.ProcessPoolExecutor(self._workers,
+                                                                mp_context=multiprocessing.get_context('spawn'))
+        self._max_queue = max_queue
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._verify_latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        self._verify_count = 0
+
+    # Checks a password against a bcrypt hash, the future gives a bool
+    def verify(self, password, hashed):
+        start = time.perf_counter()
+        future = self._submit(_verify_password, password, hashed)
+        future.add_done_callback(lambda future: self._record_verify(time.perf_counter() - start))
+        return future
+
+    # Hashes a password, the future gives the hash as bytes
+    def hash(self, password, rounds=BCRYPT_ROUNDS):
+        return self._submit(_hash_password, password, rounds)
+
+    # Returns the verify latency metrics in seconds: how many there have been,
+    # and the mean, median, 99th percentile and max of the recent ones
+    def get_metrics(self):
+        with self._lock:
+            latencies = sorted(self._verify_latencies)
+            metrics = {'verify_count': self._verify_count, 'queued': self._queued, 'workers': self._workers}
+        if latencies:
+            metrics['verify_mean'] = sum(latencies) / len(latencies)
+            metrics['verify_p50'] = latencies[len(latencies) // 2]
+            metrics['verify_p99'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            metrics['verify_max'] = latencies[-1]
+        return metrics
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, function, *args):
+        with self._lock:
+            if self._queued >= self._max_queue:
+                raise PasswordQueueFullException("{} password checks are already waiting".format(self._queued))
+            self._queued += 1
+        try:
+            future = self._executor.submit(function, *args)
+        except Exception:
+            with self._lock:
+                self._queued -= 1
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self._lock:
+            self._queued -= 1
+
+    def _record_verify(self, latency):
+        with self._lock:
+            self._verify_latencies.append(latency)
+            self._verify_count += 1
+
+
+# Raised when too many password checks are waiting already
+class PasswordQueueFullException(Exception):
+    pass
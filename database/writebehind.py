@@ -0,0 +1,95 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import threading
+from output.printlogger import *
+
+# The defaults for how often queued updates are written (seconds) and how
+# many servers are written in one transaction
+DEFAULT_FLUSH_INTERVAL = 0.5
+DEFAULT_BATCH_SIZE = 100
+
+
+# Queues updates to the servers table and writes them from a background
+# thread, so a slow database doesn't hold up whoever made the update
+# - Updates to the same server that are waiting get combined, with the newest
+# value of each column winning, and are written as one UPDATE
+# - Every flush_interval, up to batch_size servers are written in one
+# transaction, and anything left is written on the next round
+# - If a write fails, its updates go back in the queue (behind anything newer
+# for the same server) and are tried again next time
+# - close() writes everything still queued before it returns
+class WriteBehindQueue:
+    def __init__(self, db, flush_interval=DEFAULT_FLUSH_INTERVAL, batch_size=DEFAULT_BATCH_SIZE):
+        self._db = db
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._condition = threading.Condition()
+        self._pending = collections.OrderedDict()  # Unique id -> {column: value}, the oldest first
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Queues setting the columns of the server's row, for example
+    # update_server(unique_id, port=10000, online=1)
+    def update_server(self, unique_id, **columns):
+        with self._condition:
+            if self._closed:
+                log(LEVEL_STATUS, "Dropping update of server {} after shutdown: {}".format(unique_id, columns))
+                return
+            self._pending.setdefault(unique_id, {}).update(columns)
+
+    # Stops the worker and writes everything that's still queued
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait(self._flush_interval)
+                closing = self._closed
+            # On close, go until everything's written or a write fails
+            while self._flush() and closing:
+                pass
+            if closing:
+                return
+
+    # Writes a batch, returns whether there's more to write after it
+    def _flush(self):
+        with self._condition:
+            batch = []
+            while self._pending and len(batch) < self._batch_size:
+                batch.append(self._pending.popitem(last=False))
+        if not batch:
+            return False
+        try:
+            self._db.update_servers(batch)
+        except Exception as e:
+            log(LEVEL_ERROR, "Couldn't write {} server updates, retrying later: {}".format(len(batch), e))
+            with self._condition:
+                for unique_id, columns in reversed(batch):
+                    columns.update(self._pending.pop(unique_id, {}))
+                    self._pending[unique_id] = columns
+                    self._pending.move_to_end(unique_id, last=False)
+            return False
+        with self._condition:
+            return bool(self._pending)
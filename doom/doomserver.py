@@ -63,13 +63,20 @@ class DoomServer:
     SERVER_RUNNING = 1
     SERVER_CLOSED = 2
 
-    def __init__(self, json_data, doomhost):
+    # channel:
+    #   The ReplyChannel of the host request, it's told whether the server started
+    # port:
+    #   The port reserved for the server with DoomHost.reserve_port, it's given
+    #   back if the server can't be started
+    def __init__(self, json_data, doomhost, channel, port):
         self.doomhost = doomhost
-        self.port = doomhost.get_first_free_port()
+        self.channel = channel
+        self.port = port
         self.parameters = []
         self.status = self.SERVER_STARTING
         self.owner = json_data['user']
         self.unique_id = doomhost.generate_unique_id()
+        self.rconpassword = doomhost.generate_unique_id()  # Only we use RCON, so nobody needs to know it
         self.json_data = json_data
         self.hostname = self.json_data['hostname']
         self.iwad = self.json_data['iwad']
@@ -112,17 +119,21 @@ class DoomServer:
         for wad in self.wads:
             if not self.doomhost.check_wad_exists(wad):
                 log(LEVEL_WARNING, "Tried loading a server with unknown wad {}".format(wad))
-                self.doomhost.tcp_listener.reply(self.doomhost.tcp_listener.STATUS_ERROR, "File {} not found in our repository.".format(wad))
+                self.channel.reply(self.doomhost.tcp_listener.STATUS_ERROR, "File {} not found in our repository.".format(wad))
+                self.doomhost.release_port(self.port)
                 return
         for config in self.configs:
             if not self.doomhost.check_config_exists(config):
                 log(LEVEL_WARNING, "Tried loading a server with unknow config {}".format(config))
-                self.doomhost.tcp_listener.reply(self.doomhost.tcp_listener.STATUS_ERROR, "Configuration file {} does not exist.".format(config))
+                self.channel.reply(self.doomhost.tcp_listener.STATUS_ERROR, "Configuration file {} does not exist.".format(config))
+                self.doomhost.release_port(self.port)
                 return
         # Check if our iwad exists
         if not self.doomhost.check_iwad_exists(self.iwad):
             log(LEVEL_WARNING, "Tried loading a server with unknown iwad {}".format(self.iwad))
-            self.doomhost.tcp_listener.reply(self.doomhost.tcp_listener.STATUS_ERROR, "IWAD {} does not exist.".format(self.iwad))
+            self.channel.reply(self.doomhost.tcp_listener.STATUS_ERROR, "IWAD {} does not exist.".format(self.iwad))
+            self.doomhost.release_port(self.port)
+            return
         self.host_command = self.get_host_command()
         self.process = serverprocess.ServerProcess(self)
         self.doomhost.add_server(self)
@@ -150,9 +161,11 @@ class DoomServer:
         host_commands.append(self.doomhost.settings['zandronum']['executable'])
         host_commands.append('-host')
         host_commands.append('-port')
-        host_commands.append(str(self.doomhost.get_first_free_port()))
+        host_commands.append(str(self.port))
         host_commands.append('+sv_hostname')
         host_commands.append(self.doomhost.settings['zandronum']['host_name'] + self.hostname)
+        host_commands.append('+sv_rconpassword')
+        host_commands.append(self.rconpassword)
         host_commands.append('-iwad')
         host_commands.append(self.doomhost.settings['zandronum']['directories']['iwad_directory'] + self.iwad)
         # If the data is on, append the two wads to the wad list at the beginning as a workaround
@@ -13,11 +13,17 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import re
 import subprocess
 import psutil
 import threading
 from output.printlogger import *
 
+# Zandronum's console output when the map changes, and when a player joins or
+# leaves, seeing one of these means a cached query of the server is out of date
+MAP_CHANGE_OUTPUT = re.compile(r'^\*\*\* .+ \*\*\*$')
+PLAYER_CHANGE_OUTPUT = re.compile(r' has connected\.$| disconnected\.$| timed out\.$| was kicked')
+
 
 class ServerProcess():
     def __init__(self, server):
@@ -34,18 +40,23 @@ class ServerProcess():
             if self.server.status == self.server.SERVER_STARTING:
                 if line == "UDP Initialized.\n":
                     # Our server is online
-                    self.server.doomhost.db.update_port(self.server.unique_id, self.server.port)
-                    self.server.doomhost.db.toggle_online(self.server.unique_id)
+                    self.server.doomhost.db_writes.update_server(self.server.unique_id, port=self.server.port, online=1)
                     log(LEVEL_OK, "Server from {} on port {} started successfully.".format(self.server.owner['username'], self.server.port))
                     self.server.status = self.server.SERVER_RUNNING
-                    self.server.doomhost.tcp_listener.reply(self.server.doomhost.tcp_listener.STATUS_OK, "Server started!")
+                    self.server.channel.reply(self.server.doomhost.tcp_listener.STATUS_OK, "Server started!", final=True)
+                    self.server.doomhost.watch_server(self.server)
+            elif MAP_CHANGE_OUTPUT.search(line.rstrip('\n')):
+                self.server.doomhost.invalidate_query(self.server.port, map_changed=True)
+            elif PLAYER_CHANGE_OUTPUT.search(line.rstrip('\n')):
+                self.server.doomhost.invalidate_query(self.server.port)
         # This means our program terminated
         if self.server.status == self.server.SERVER_STARTING:
-            self.server.doomhost.tcp_listener.reply(self.server.doomhost.tcp_listener.STATUS_ERROR, "There was a problem starting your server.")
+            self.server.channel.reply(self.server.doomhost.tcp_listener.STATUS_ERROR, "There was a problem starting your server.", final=True)
         log(LEVEL_OK, "Server from {} on port {} was stopped.".format(self.server.owner['username'], self.server.port))
         if self.server.status == self.server.SERVER_RUNNING:
+            self.server.doomhost.close_rcon(self.server.port)
             self.server.doomhost.remove_server(self.server)
-            self.server.doomhost.db.toggle_online(self.server.unique_id)
+            self.server.doomhost.db_writes.update_server(self.server.unique_id, online=0)
         self.server.status = self.server.SERVER_CLOSED
 
     def kill_server(self):
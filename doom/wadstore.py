@@ -0,0 +1,89 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import threading
+import uuid
+from output.printlogger import *
+
+# Where the blobs are kept, inside the directory the store is for
+BLOB_DIRECTORY = '.blobs'
+
+# Where uploads are written before they become a blob, it's inside the store
+# so moving them into place is a rename on the same filesystem
+TEMP_DIRECTORY = 'tmp'
+
+# What a sha256 hex digest looks like
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+# Checks if a string is a sha256 hex digest
+def is_valid_digest(digest):
+    return isinstance(digest, str) and SHA256_PATTERN.match(digest) is not None
+
+
+# Keeps every uploaded file once, named by the sha256 of its contents
+# - The names servers load files by are hardlinks to the blobs (or symlinks
+# if the filesystem won't hardlink), so the same WAD uploaded under many
+# names or by many users only takes up space once
+# - Blobs are at <directory>/.blobs/<first 2 hex digits>/<digest>
+class WadStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self._blob_directory = os.path.join(directory, BLOB_DIRECTORY)
+        self._temp_directory = os.path.join(self._blob_directory, TEMP_DIRECTORY)
+        self._lock = threading.Lock()
+        os.makedirs(self._temp_directory, exist_ok=True)
+
+    def blob_path(self, digest):
+        return os.path.join(self._blob_directory, digest[:2], digest)
+
+    def has_blob(self, digest):
+        return is_valid_digest(digest) and os.path.isfile(self.blob_path(digest))
+
+    # Returns a path to write an upload to before it's added with add_blob
+    def make_temp_path(self):
+        return os.path.join(self._temp_directory, uuid.uuid4().hex)
+
+    # Moves a finished upload into the store under its digest, if the store
+    # already has those contents the upload is just deleted
+    def add_blob(self, temp_path, digest):
+        path = self.blob_path(digest)
+        with self._lock:
+            if os.path.isfile(path):
+                os.remove(temp_path)
+                return path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        return path
+
+    # Points the name (a file name in the store's directory) at the blob,
+    # replacing whatever had that name before
+    def link(self, digest, name):
+        path = os.path.join(self.directory, name)
+        blob = self.blob_path(digest)
+        temp_link = self.make_temp_path()
+        try:
+            os.link(blob, temp_link)
+        except OSError:
+            # Hardlinks aren't allowed on every filesystem, fall back to a symlink
+            os.symlink(os.path.relpath(blob, os.path.dirname(path) or '.'), temp_link)
+        try:
+            os.replace(temp_link, path)
+        except OSError:
+            os.remove(temp_link)
+            raise
+        log(LEVEL_STATUS, "Linked {} to blob {}".format(path, digest))
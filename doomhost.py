@@ -21,9 +21,17 @@ import os.path
 import threading
 import atexit
 import signal
+import socket
 import doom.servermonitor
+from doom import wadstore
 from database import mysql
+from database import writebehind
 from net import tcplistener
+from net import serverpoller
+from net import serverquery
+from net import querycache
+from net import rcon
+from net import rconmonitor
 from output.printlogger import *
 
 working = False
@@ -49,6 +57,9 @@ class DoomHost:
     }
 
     def __init__(self):
+        # Ports of servers that are being set up, see reserve_port
+        self.reserved_ports = set()
+        self.port_lock = threading.Lock()
         # This needs to be called or else colored outputs won't work on windows
         init()
         # Attempt to load configuration file
@@ -89,14 +100,31 @@ class DoomHost:
                     sys.exit(1)
             else:
                 log(LEVEL_OK, "{} exists.".format(logfile))
+        # Uploaded files are kept once each by their contents, with their names linked to them
+        self.wad_stores = {location: wadstore.WadStore(location) for location in set(self.filetype_locations.values())}
         # Check to see if mysql database settings are correct
         self.db = mysql.MySQL(self)
         try:
-            self.db.connect()
+            self.db.ping()
         except mysql.pymysql.MySQLError as e:
             log(LEVEL_ERROR, "MySQL configuration error: {}".format(e))
             sys.exit(1)
         log(LEVEL_OK, "MySQL connection succeeded!")
+        # Servers going on and offline are written to the database in the background
+        self.db_writes = writebehind.WriteBehindQueue(self.db, self.settings['advanced']['db_flush_interval'],
+                                                      self.settings['advanced']['db_flush_batch_size'])
+        # Everything that wants a server's status goes through the query cache
+        self.query_ip = socket.gethostbyname(self.settings['network']['public_ip'])
+        # Between full refreshes only the fields that change while a server runs are asked for
+        self.query_delta_tracker = serverquery.DeltaTracker(self.settings['advanced']['query_full_refresh_interval'])
+        self.query_cache = querycache.QueryCache(self.settings['advanced']['query_cache_ttl'],
+                                                 lambda ip, port: serverquery.perform_delta_server_query(
+                                                     self.query_delta_tracker, ip, port))
+        # Commands to our servers go through one logged in RCON session each
+        self.rcon_pool = rcon.RCONSessionPool()
+        # The players and map of every running server are pushed to us over RCON
+        self.rcon_monitor = rconmonitor.RCONMonitor(self.rcon_pool)
+        self.rcon_monitor.add_listener(self._on_rcon_event)
         # Set up our threaded server monitor
         if platform.system() == "Linux":
             self.monitor = doom.servermonitor.ServerMonitor(self)
@@ -108,7 +136,12 @@ class DoomHost:
         # Attempt to start our TCP server
         self.tcp_listener = tcplistener.TCPListener(self, self.settings['network']['hostname'],
                                                 self.settings['network']['port'],
-                                                self.settings['network']['secret'])
+                                                self.settings['network']['secret'],
+                                                self.settings['network']['max_connections'],
+                                                self.settings['network']['max_uploads'],
+                                                self.settings['network']['upload_chunk_size'],
+                                                self.settings['network']['session_ttl'],
+                                                self.settings['network']['max_upload_size'])
         atexit.register(_cleanup, self)
         self.tcp_listener.serve()
 
@@ -131,19 +164,112 @@ class DoomHost:
 
     # Removes a server from our list
     def remove_server(self, server):
-        self.servers.remove(server)
+        with self.port_lock:
+            self.servers.remove(server)
 
-    # Adds a server to our list
+    # Adds a server to our list, its port stops being reserved since the server has it now
     def add_server(self, server):
-        self.servers.append(server)
+        with self.port_lock:
+            self.servers.append(server)
+            self.reserved_ports.discard(server.port)
+
+    # Queries every running server at once, returns a dict of port -> reply
+    # The replies are put into the query cache as well
+    def query_servers(self):
+        results = serverpoller.sweep_servers(self)
+        for port, result in results.items():
+            self.query_cache.put(self.query_ip, port, result)
+        return results
+
+    # Gets the (possibly cached) query reply of the server on a port
+    def query_server(self, port):
+        return self.query_cache.query(self.query_ip, port)
+
+    # Drops the cached query reply of the server on a port, for when we know
+    # something about it has changed
+    # - Players coming and going are what delta queries pick up, so the server's
+    # delta snapshot is only thrown away (for a full query) when the map changed
+    def invalidate_query(self, port, map_changed=False):
+        self.query_cache.invalidate(self.query_ip, port)
+        if map_changed:
+            self.query_delta_tracker.invalidate((self.query_ip, port))
+
+    # Drops the cached query reply of the server on a port if an RCON command
+    # we sent to it changes what it returns
+    def _invalidate_after_command(self, port, command):
+        self.query_cache.invalidate_after_command(self.query_ip, port, command)
+        if querycache.changes_map(command):
+            self.query_delta_tracker.invalidate((self.query_ip, port))
+
+    # Sends an RCON command to the server on a port, returns whether it was sent
+    def send_rcon(self, port, command):
+        server = self.get_server(port)
+        if server is None:
+            return False
+        if not self.rcon_pool.send_command(self.query_ip, port, server.rconpassword, command):
+            return False
+        self._invalidate_after_command(port, command)
+        return True
+
+    # Sends an RCON command to many servers at once, which are all of our running
+    # servers or only the ones the owner has up, returns a dict of
+    # port -> rcon.BROADCAST_SENT, rcon.BROADCAST_FAILED or rcon.BROADCAST_TIMEOUT
+    def broadcast_rcon(self, command, owner_id=None):
+        servers = [server for server in list(self.servers) if server.status == server.SERVER_RUNNING and
+                   (owner_id is None or server.owner['id'] == owner_id)]
+        results = rcon.broadcast_command(self.rcon_pool,
+                                         [(self.query_ip, server.port, server.rconpassword) for server in servers],
+                                         command, self.settings['advanced']['rcon_broadcast_timeout'],
+                                         self.settings['advanced']['rcon_broadcast_workers'])
+        for (ip, port), result in results.items():
+            if result == rcon.BROADCAST_SENT:
+                self._invalidate_after_command(port, command)
+        return {port: result for (ip, port), result in results.items()}
+
+    # Starts following the players and map of a server that just came up,
+    # without waiting for the RCON login
+    def watch_server(self, server):
+        self.rcon_monitor.watch(self.query_ip, server.port, server.rconpassword)
+
+    # Gets what RCON last told us about the server on a port, as a
+    # rconmonitor.LiveServerState (or None if we aren't following it)
+    def get_live_state(self, port):
+        return self.rcon_monitor.get_state(self.query_ip, port)
+
+    # Called from the UDP transport's thread for every RCON update
+    def _on_rcon_event(self, address, event, value):
+        if event == rconmonitor.EVENT_MAP:
+            self.invalidate_query(address[1], map_changed=True)
+        elif event == rconmonitor.EVENT_PLAYERS:
+            self.invalidate_query(address[1])
+
+    # Logs out of the RCON session of the server on a port, for when it stops
+    def close_rcon(self, port):
+        self.rcon_monitor.unwatch(self.query_ip, port)
+        self.rcon_pool.remove(self.query_ip, port)
 
     # Gets the first free port
     def get_first_free_port(self):
         for temp_port in range(self.settings['zandronum']['min_port'], self.settings['zandronum']['max_port']):
-            if self.get_server(temp_port) is None:
+            if self.get_server(temp_port) is None and temp_port not in self.reserved_ports:
                 return temp_port
         return None
 
+    # Takes the first free port for a server that's being set up, so nothing
+    # else can get it until add_server or release_port, returns None if
+    # there are no free ports
+    def reserve_port(self):
+        with self.port_lock:
+            port = self.get_first_free_port()
+            if port is not None:
+                self.reserved_ports.add(port)
+            return port
+
+    # Gives back a reserved port for a server that couldn't be set up
+    def release_port(self, port):
+        with self.port_lock:
+            self.reserved_ports.discard(port)
+
     def check_valid_file(self, type, extension):
         try:
             type = int(type)
@@ -155,6 +281,10 @@ class DoomHost:
             return (False, "{} extensions are not allowed for that type of file.".format(extension))
         return (True, self.filetype_locations[type])
 
+    # Gets the WadStore that keeps the files of a directory from filetype_locations
+    def get_wad_store(self, location):
+        return self.wad_stores[location]
+
     # Generate a random 32 character hex string
     def generate_unique_id(self):
         return uuid.uuid4().hex
@@ -182,8 +312,13 @@ def _cleanup(doomhost):
     log(LEVEL_STATUS, "Cleaning up...")
     doomhost.tcp_listener.socket.close()
     doomhost.working = False
-    for server in doomhost.servers:
+    doomhost.rcon_monitor.close()
+    doomhost.rcon_pool.close()
+    for server in list(doomhost.servers):
         server.process.kill_server()
+        doomhost.db_writes.update_server(server.unique_id, online=0)
+    doomhost.db_writes.close()
+    doomhost.db.close()
 
 def main(args):
     host =  DoomHost()
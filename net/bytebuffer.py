@@ -13,165 +13,272 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from struct import pack, unpack
+from struct import Struct
+
+
+# Precompiled structs for every type we read and write, one set per endianness
+class _Structs:
+    def __init__(self, prefix):
+        self.byteorder = prefix
+        self.short = Struct(prefix + 'h')
+        self.short_unsigned = Struct(prefix + 'H')
+        self.int = Struct(prefix + 'l')
+        self.int_unsigned = Struct(prefix + 'L')
+        self.float = Struct(prefix + 'f')
+        self.long = Struct(prefix + 'q')
+        self.long_unsigned = Struct(prefix + 'Q')
+
+_LITTLE_ENDIAN_STRUCTS = _Structs('<')
+_BIG_ENDIAN_STRUCTS = _Structs('>')
+
+
+# The layout of a record made up of several fields that are read or written in
+# one call with ByteBuffer.get_record/put_record
+# - The format uses the struct module's characters (without a byte order, that
+# comes from the buffer) plus 'z' for a null terminated string
+# - For example, a player in a server query reply is Schema('zhhBBBB'): the name,
+# then two shorts and four bytes
+class Schema:
+    def __init__(self, format_, encoding='latin1'):
+        self.format = format_
+        self.encoding = encoding
+        # The compiled segments for each byte order
+        self.segments = {'<': self._compile('<'), '>': self._compile('>')}
+        # The smallest a record can be, strings count as just their terminator
+        self.size = sum(1 if segment is None else segment[0].size for segment in self.segments['<'])
+
+    # Splits the format into a list of segments, None for a string or a tuple of
+    # (struct, value count) for a run of fixed size fields
+    def _compile(self, prefix):
+        segments = []
+        for index, run in enumerate(self.format.split('z')):
+            if index > 0:
+                segments.append(None)
+            if run.strip():
+                compiled = Struct(prefix + run)
+                segments.append((compiled, len(compiled.unpack(bytes(compiled.size)))))
+        return segments
 
 
 # A buffer class for bytes that are read in a FIFO pattern
 # - For example, when sockets communicate a short and a long, you want to read
 # the short first, and then the long... this class allows that
+# - Reads move an offset forward instead of removing bytes from the front, and
+# data passed to the constructor is read in place without being copied until
+# something new is put into the buffer
+# - Writes go into a bytearray that grows by doubling, values are packed
+# straight into it. Pass a capacity when the size of a packet is known so it
+# only needs one allocation, and use get_view() to send it without a copy
 # - Any invalid operations for 'getters' (like not enough bytes in the buffer)
 # will yield a ByteBufferException
 class ByteBuffer:
-    def __init__(self, is_little_endian_boolean):
-        self._bytedata = []
+
+    # Once this many bytes have been read, the next put will discard them
+    COMPACT_THRESHOLD = 4096
+
+    # The smallest amount a buffer grows to when it needs more room
+    MINIMUM_CAPACITY = 64
+
+    def __init__(self, is_little_endian_boolean, data=None, capacity=0):
+        if data is None:
+            self._bytedata = bytearray(capacity)
+            self._end = 0
+        else:
+            if isinstance(data, (bytes, bytearray)):
+                self._bytedata = data
+            else:
+                # Views and such don't support find(), so take a copy
+                self._bytedata = bytes(data)
+            self._end = len(self._bytedata)
+        self._readpos = 0
+        self._writable = isinstance(self._bytedata, bytearray) and data is None
         self._little_endian = is_little_endian_boolean
+        self._structs = _LITTLE_ENDIAN_STRUCTS if is_little_endian_boolean else _BIG_ENDIAN_STRUCTS
 
     def size(self):
-        return len(self._bytedata)
+        return self._end - self._readpos
 
     def clear(self):
-        del self._bytedata
-        self._bytedata = []
+        self._readpos = 0
+        self._end = 0
+        if not self._writable:
+            self._bytedata = bytearray()
+            self._writable = True
+
+    # Makes room for the amount of bytes at the end and returns the position to
+    # write them at
+    # - Raises BufferError if it has to grow while a view from get_view() is
+    # still held
+    def _reserve(self, numbytes):
+        if not self._writable:
+            # Data from the constructor is never written to, copy what's left
+            self._bytedata = bytearray(self._bytedata[self._readpos:self._end])
+            self._end -= self._readpos
+            self._readpos = 0
+            self._writable = True
+        elif self._readpos >= self.COMPACT_THRESHOLD and self._readpos * 2 >= self._end:
+            del self._bytedata[:self._readpos]
+            self._end -= self._readpos
+            self._readpos = 0
+        position = self._end
+        self._end += numbytes
+        if self._end > len(self._bytedata):
+            self._bytedata.extend(bytes(max(self._end, len(self._bytedata) * 2, self.MINIMUM_CAPACITY) - len(self._bytedata)))
+        return position
+
+    # Returns a view of the unread bytes without copying them
+    # - Release the view (or let it go) before putting anything else in, the
+    # buffer can't grow while it's held
+    def get_view(self):
+        return memoryview(self._bytedata)[self._readpos:self._end]
 
     def put_bytes(self, bytes_):
-        self._bytedata.extend(bytes_)
+        if not isinstance(bytes_, (bytes, bytearray)):
+            try:
+                bytes_ = memoryview(bytes_).cast('B')
+            except TypeError:
+                bytes_ = bytes(bytes_)  # A list of ints or something like it
+        position = self._reserve(len(bytes_))
+        self._bytedata[position:self._end] = bytes_
 
     def put_byte(self, byte_):
-        self._bytedata.append(byte_)
+        position = self._reserve(1)
+        self._bytedata[position] = byte_
+
+    # Packs a single value at the end
+    def _pack(self, struct_, value):
+        position = self._reserve(struct_.size)
+        struct_.pack_into(self._bytedata, position, value)
 
     def put_short(self, short_):
-        data = pack("<h" if self._little_endian else ">h", short_)
-        for b in data:
-            self._bytedata.append(b)
+        self._pack(self._structs.short, short_)
 
     def put_short_unsigned(self, short_):
-        data = pack("<H" if self._little_endian else ">H", short_)
-        for b in data:
-            self._bytedata.append(b)
+        self._pack(self._structs.short_unsigned, short_)
 
     def put_int(self, int_):
-        data = pack("<l" if self._little_endian else ">l", int_)
-        for b in data:
-            self._bytedata.append(b)
+        self._pack(self._structs.int, int_)
 
     def put_int_unsigned(self, int_):
-        data = pack("<L" if self._little_endian else ">L", int_)
-        for b in data:
-            self._bytedata.append(b)
+        self._pack(self._structs.int_unsigned, int_)
 
     def put_float(self, float_):
-        data = pack("<f" if self._little_endian else ">f", float_)
-        for b in data:
-            self._bytedata.append(b)
+        self._pack(self._structs.float, float_)
 
     def put_long(self, long_):
-        data = pack("<q" if self._little_endian else ">q", long_)
-        for b in data:
-            self._bytedata.append(b)
+        self._pack(self._structs.long, long_)
 
     def put_long_unsigned(self, long_):
-        data = pack("<Q" if self._little_endian else ">Q", long_)
-        for b in data:
-            self._bytedata.append(b)
+        self._pack(self._structs.long_unsigned, long_)
 
     def put_string(self, str_, encodetype='latin1', null_terminator=False):
-        for b in str_.encode(encodetype):
-            self._bytedata.append(b)
+        self.put_bytes(str_.encode(encodetype))
         if null_terminator:
-            self._bytedata.append(0)
+            self.put_byte(0)
 
     def peek_front_byte(self):
-        if len(self._bytedata) == 0:
+        if self._readpos >= self._end:
             raise ByteBufferException("ByteBuffer is empty, cannot peek at a byte from an empty buffer.")
-        return self._bytedata[0]
+        return self._bytedata[self._readpos]
 
     def get_byte(self):
-        if len(self._bytedata) == 0:
+        if self._readpos >= self._end:
             raise ByteBufferException("ByteBuffer is empty, cannot get a byte from an empty buffer.")
-        return self._bytedata.pop(0)
+        self._readpos += 1
+        return self._bytedata[self._readpos - 1]
 
     def get_all_bytes(self):
-        if len(self._bytedata) == 0:
+        if self._readpos >= self._end:
             raise ByteBufferException("ByteBuffer is empty, cannot get all bytes from an empty buffer.")
-        return_bytes = self._bytedata[:]  # Copy the bytes
-        self._bytedata = []
+        return_bytes = bytes(self._bytedata[self._readpos:self._end])
+        self.clear()
         return return_bytes
 
+    # Unpacks a single value from the read position
+    def _unpack(self, struct_):
+        value = struct_.unpack_from(self._bytedata, self._readpos)[0]
+        self._readpos += struct_.size
+        return value
+
     def get_short(self):
-        if len(self._bytedata) < 2:
+        if self._end - self._readpos < 2:
             raise ByteBufferException("Less than two bytes in the ByteBuffer, cannot extract a signed short.")
-        data = bytearray()
-        for i in range(2):
-            data.append(self._bytedata.pop(0))
-        return unpack("<h" if self._little_endian else ">h", bytes(data))[0]
+        return self._unpack(self._structs.short)
 
     def get_short_unsigned(self):
-        if len(self._bytedata) < 2:
+        if self._end - self._readpos < 2:
             raise ByteBufferException("Less than two bytes in the ByteBuffer, cannot extract an unsigned short.")
-        data = bytearray()
-        for i in range(2):
-            data.append(self._bytedata.pop(0))
-        return unpack("<H" if self._little_endian else ">H", bytes(data))[0]
+        return self._unpack(self._structs.short_unsigned)
 
     def get_int(self):
-        if len(self._bytedata) < 4:
+        if self._end - self._readpos < 4:
             raise ByteBufferException("Less than four bytes in the ByteBuffer, cannot extract a signed int.")
-        data = bytearray()
-        for i in range(4):
-            data.append(self._bytedata.pop(0))
-        return unpack("<l" if self._little_endian else ">l", bytes(data))[0]
+        return self._unpack(self._structs.int)
 
     def get_int_unsigned(self):
-        if len(self._bytedata) < 4:
+        if self._end - self._readpos < 4:
             raise ByteBufferException("Less than four bytes in the ByteBuffer, cannot extract an unsigned int.")
-        data = bytearray()
-        for i in range(4):
-            data.append(self._bytedata.pop(0))
-        return unpack("<L" if self._little_endian else ">L", bytes(data))[0]
+        return self._unpack(self._structs.int_unsigned)
 
     def get_float(self):
-        if len(self._bytedata) < 4:
+        if self._end - self._readpos < 4:
             raise ByteBufferException("Less than four bytes in the ByteBuffer, cannot extract a float.")
-        data = bytearray()
-        for i in range(4):
-            data.append(self._bytedata.pop(0))
-        return unpack("<f" if self._little_endian else ">f", bytes(data))[0]
+        return self._unpack(self._structs.float)
 
     def get_long(self):
-        if len(self._bytedata) < 8:
+        if self._end - self._readpos < 8:
             raise ByteBufferException("Less than eight bytes in the ByteBuffer, cannot extract a signed long.")
-        data = bytearray()
-        for i in range(8):
-            data.append(self._bytedata.pop(0))
-        return unpack("<q" if self._little_endian else ">q", bytes(data))[0]
+        return self._unpack(self._structs.long)
 
     def get_long_unsigned(self):
-        if len(self._bytedata) < 8:
+        if self._end - self._readpos < 8:
             raise ByteBufferException("Less than eight bytes in the ByteBuffer, cannot extract an unsigned long.")
-        data = bytearray()
-        for i in range(8):
-            data.append(self._bytedata.pop(0))
-        return unpack("<Q" if self._little_endian else ">Q", bytes(data))[0]
+        return self._unpack(self._structs.long_unsigned)
 
     def get_string(self, numchars, decoding='latin1'):
-        if numchars > len(self._bytedata):
+        if numchars > self._end - self._readpos:
             raise ByteBufferException("Not enough bytes in the ByteBuffer to extract a string")
-        rawdata = bytearray()
-        for i in range(numchars):
-            rawdata.append(self._bytedata.pop(0))
+        rawdata = self._bytedata[self._readpos:self._readpos + numchars]
+        self._readpos += numchars
         return rawdata.decode(decoding)
 
     def get_string_null_terminated(self, decoding='latin1'):
-        rawdata = bytearray()
-        while True:
-            if len(self._bytedata) == 0:
-                raise ByteBufferException("Did not find null terminator before ByteBuffer reached the end of it's data")
-            b = self._bytedata.pop(0)
-            if b == 0:
-                break
-            rawdata.append(b)
+        end = self._bytedata.find(b'\0', self._readpos, self._end)
+        if end < 0:
+            # Everything gets consumed looking for the terminator
+            self._readpos = self._end
+            raise ByteBufferException("Did not find null terminator before ByteBuffer reached the end of it's data")
+        rawdata = self._bytedata[self._readpos:end]
+        self._readpos = end + 1
         return rawdata.decode(decoding)
 
+    # Puts every field of a record, the values are in the same order as the schema
+    def put_record(self, schema, values):
+        index = 0
+        for segment in schema.segments[self._structs.byteorder]:
+            if segment is None:
+                self.put_string(values[index], schema.encoding, True)
+                index += 1
+            else:
+                struct_, count = segment
+                position = self._reserve(struct_.size)
+                struct_.pack_into(self._bytedata, position, *values[index:index + count])
+                index += count
+
+    # Gets every field of a record and returns them as a tuple
+    def get_record(self, schema):
+        values = []
+        for segment in schema.segments[self._structs.byteorder]:
+            if segment is None:
+                values.append(self.get_string_null_terminated(schema.encoding))
+            else:
+                struct_, count = segment
+                if self._end - self._readpos < struct_.size:
+                    raise ByteBufferException("Not enough bytes in the ByteBuffer to extract a '{}' record.".format(schema.format))
+                values.extend(struct_.unpack_from(self._bytedata, self._readpos))
+                self._readpos += struct_.size
+        return tuple(values)
+
 
 # Indicates something bad occured in the bytebuffer, like improper index or some overflow
 class ByteBufferException(Exception):
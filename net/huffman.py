@@ -13,6 +13,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# NumPy is only used by the batch functions, which fall back to encoding and
+# decoding one packet at a time if it's not installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # The huffman values compatible with Zandronum/Skulltag
 # - Bitcodes are least signifant from the left, this way it's possible to
 # iterate through them from the beginning.
@@ -287,6 +294,7 @@ __huffman_compatible_bitcodes = (
 class HuffmanNode:
     def __init__(self):
         self.byteindex = -1
+        self.nodeindex = -1
         self.bitcode = []
         self.children = [None, None]
 
@@ -297,9 +305,34 @@ __rootnode = HuffmanNode()
 # A list of the encoding nodes
 __encodingnodes = []
 
+# The bitcode of every byte as an (integer, length) tuple, where the first bit
+# of the code is the least significant bit of the integer
+__encodingcodes = []
+
 # A list of masks used for selecting bits
 __huffman_bitmasks = (0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80)
 
+# A list of the internal (non leaf) nodes, the position of a node in this list
+# is the decoder state it corresponds to
+__decodingnodes = []
+
+# The decoding table, indexed by (state << 8) | byte where state is the index
+# of the internal node we're sitting on before consuming the byte
+# - Each entry is a tuple of (decoded bytes, next state << 8), so decoding is a
+# single lookup per input byte instead of walking the tree one bit at a time
+__decodingtable = []
+
+# The encoding/decoding tables as numpy arrays for the batch functions, these
+# are only made the first time a batch is processed
+__batchtables = {}
+
+# Batches smaller than these aren't worth the numpy overhead
+# - Decoding is stepped one byte at a time across the whole batch, so it needs a
+# lot more packets than encoding does before it pays off
+# (see benchmarks/huffmanbatch.py)
+ENCODE_BATCH_MINIMUM = 8
+DECODE_BATCH_MINIMUM = 1024
+
 # Checks if the module was initialized
 __is_initialized = False
 
@@ -324,6 +357,50 @@ def __init_huffman():
                 node.byteindex = bytenum
                 __encodingnodes.append(node)
                 break
+        code = 0
+        for bitindex, bitvalue in enumerate(bitcodestring):
+            code |= int(bitvalue) << bitindex
+        __encodingcodes.append((code, len(bitcodestring)))
+    __init_decoding_table()
+
+
+# Walks the tree starting from a node for the given bits (least significant
+# first) and returns a tuple of the decoded bytes and the node we ended on
+def __walk_bits(node, bits, numbits):
+    decoded = bytearray()
+    for bitindex in range(numbits):
+        node = node.children[(bits >> bitindex) & 1]
+        if node.byteindex != -1:
+            decoded.append(node.byteindex)
+            node = __rootnode
+    return bytes(decoded), node
+
+
+# Builds the byte at a time decoding table
+# - A nibble table is built first by walking the tree, then every byte entry
+# is made by chaining the low nibble and the high nibble entries, which keeps
+# the startup cost down
+def __init_decoding_table():
+    # Number the internal nodes, the root has to be state 0
+    pending = [__rootnode]
+    while pending:
+        node = pending.pop()
+        if node.byteindex == -1:
+            node.nodeindex = len(__decodingnodes)
+            __decodingnodes.append(node)
+            pending.extend(node.children)
+
+    nibbletable = []
+    for node in __decodingnodes:
+        for nibble in range(16):
+            decoded, endnode = __walk_bits(node, nibble, 4)
+            nibbletable.append((decoded, endnode.nodeindex << 4))
+
+    for state in range(len(__decodingnodes)):
+        for byte in range(256):
+            lowdecoded, midstate = nibbletable[(state << 4) | (byte & 0x0F)]
+            highdecoded, endstate = nibbletable[midstate | (byte >> 4)]
+            __decodingtable.append((lowdecoded + highdecoded, endstate << 4))
 
 
 def bindump(rawbytes):
@@ -338,8 +415,61 @@ def bindump(rawbytes):
 
 
 # Encodes the data and returns the encoded bytes
-# This probably can be optimized
 def encode(rawdata):
+    encodeddata = bytearray(len(rawdata) + 1)
+    del encodeddata[encode_into(rawdata, encodeddata):]
+    return encodeddata
+
+
+# Encodes the data into a buffer we were given and returns how many bytes were
+# written, the source and destination can be anything supporting the buffer
+# protocol (bytes, bytearray, memoryview...)
+# - The encoded data is never longer than the source plus the header byte, a
+# smaller destination raises a ValueError
+# - Codes are packed into an integer accumulator which is flushed eight bytes at
+# a time, and we bail out to the unencoded form as soon as the output can't be
+# smaller than the input
+def encode_into(rawdata, encodeddata):
+    if not isinstance(rawdata, (bytes, bytearray)):
+        rawdata = memoryview(rawdata).cast('B')
+    if not isinstance(encodeddata, bytearray):
+        encodeddata = memoryview(encodeddata).cast('B')
+    # If the length is not correct, there's nothing to write
+    if len(rawdata) <= 0:
+        return 0
+    if len(encodeddata) < len(rawdata) + 1:
+        raise ValueError("Destination buffer needs at least {} bytes to encode into.".format(len(rawdata) + 1))
+
+    # Same cutoff as the bitwise encoder: (bits / 8) + 1 >= length
+    maxbits = (len(rawdata) - 1) * 8
+    codes = __encodingcodes
+    position = 1
+    accumulator = 0
+    accumulatedbits = 0
+    totalbits = 0
+    for b in rawdata:
+        code, length = codes[b]
+        accumulator |= code << accumulatedbits
+        accumulatedbits += length
+        totalbits += length
+        if totalbits >= maxbits:
+            encodeddata[0] = 0xFF  # Compatibility issues with Zan/ST
+            encodeddata[1:len(rawdata) + 1] = rawdata
+            return len(rawdata) + 1
+        if accumulatedbits >= 64:
+            encodeddata[position:position + 8] = (accumulator & 0xFFFFFFFFFFFFFFFF).to_bytes(8, 'little')
+            position += 8
+            accumulator >>= 64
+            accumulatedbits -= 64
+    remainingbytes = (accumulatedbits + 7) >> 3
+    encodeddata[position:position + remainingbytes] = accumulator.to_bytes(remainingbytes, 'little')
+    encodeddata[0] = -totalbits & 7
+    return position + remainingbytes
+
+
+# Encodes the data a bit at a time
+# This is the reference implementation that the accumulator encoder has to match
+def encode_bitwise(rawdata):
     # If the length is not correct, return an empty byte array
     if len(rawdata) <= 0:
         return bytearray()
@@ -380,6 +510,99 @@ def encode(rawdata):
 
 # Decodes the encoded data
 def decode(encodeddata):
+    if not isinstance(encodeddata, (bytes, bytearray)):
+        encodeddata = memoryview(encodeddata).cast('B')
+    # If the length is not correct, return an empty byte array
+    if len(encodeddata) <= 0:
+        return bytearray()
+
+    # If the header is 0xFF, remove that and return the list
+    if encodeddata[0] == 0xFF:
+        return bytearray(encodeddata[1:])
+
+    # The header holds the amount of padding bits at the end, anything that
+    # fits into whole bytes goes through the table and the rest is walked
+    numbits = ((len(encodeddata) - 1) * 8) - encodeddata[0]
+    if numbits <= 0:
+        return bytearray()
+    numbytes = numbits >> 3
+
+    table = __decodingtable
+    state = 0
+    decodeddata = bytearray()
+    for byte in encodeddata[1:numbytes + 1]:
+        decoded, state = table[state | byte]
+        decodeddata += decoded
+
+    # Finish off any bits in the last partially filled byte
+    if numbits & 7:
+        decoded, node = __walk_bits(__decodingnodes[state >> 8], encodeddata[numbytes + 1], numbits & 7)
+        decodeddata += decoded
+    return decodeddata
+
+
+# Returns the most bytes the encoded data can decode to, which is the size a
+# destination buffer for decode_into needs to be
+def max_decoded_length(encodeddata):
+    if len(encodeddata) <= 0:
+        return 0
+    if encodeddata[0] == 0xFF:
+        return len(encodeddata) - 1
+    # The shortest code is three bits long
+    return max(0, ((len(encodeddata) - 1) * 8) - encodeddata[0]) // 3
+
+
+# Decodes the data into a buffer we were given and returns how many bytes were
+# written, the source and destination can be anything supporting the buffer
+# protocol (bytes, bytearray, memoryview...)
+# - The decoded bytes go straight into the destination, nothing is allocated
+# for them. A destination that's too small raises a ValueError, use
+# max_decoded_length() for one that's always big enough
+def decode_into(encodeddata, decodeddata):
+    encodeddata = memoryview(encodeddata).cast('B')
+    out = memoryview(decodeddata).cast('B')
+    if len(encodeddata) <= 0:
+        return 0
+
+    # Unencoded data is copied straight across
+    if encodeddata[0] == 0xFF:
+        length = len(encodeddata) - 1
+        if len(out) < length:
+            raise ValueError("Destination buffer needs at least {} bytes to decode into.".format(length))
+        out[:length] = encodeddata[1:]
+        return length
+
+    numbits = ((len(encodeddata) - 1) * 8) - encodeddata[0]
+    if numbits <= 0:
+        return 0
+    numbytes = numbits >> 3
+
+    table = __decodingtable
+    state = 0
+    position = 0
+    limit = len(out)
+    for byte in encodeddata[1:numbytes + 1]:
+        decoded, state = table[state | byte]
+        end = position + len(decoded)
+        if end > limit:
+            raise ValueError("Destination buffer of {} bytes is too small to decode into.".format(limit))
+        out[position:end] = decoded
+        position = end
+
+    # Finish off any bits in the last partially filled byte
+    if numbits & 7:
+        decoded, node = __walk_bits(__decodingnodes[state >> 8], encodeddata[numbytes + 1], numbits & 7)
+        end = position + len(decoded)
+        if end > limit:
+            raise ValueError("Destination buffer of {} bytes is too small to decode into.".format(limit))
+        out[position:end] = decoded
+        position = end
+    return position
+
+
+# Decodes the encoded data by walking the tree a bit at a time
+# This is the reference implementation that the table decoder has to match
+def decode_bitwise(encodeddata):
     # If the length is not correct, return an empty byte array
     if len(encodeddata) <= 0:
         return bytearray()
@@ -403,6 +626,162 @@ def decode(encodeddata):
     return decodeddata
 
 
+# Converts the tables into numpy arrays for the batch functions
+def __get_batch_tables():
+    if not __batchtables:
+        __batchtables['codes'] = numpy.array([code for code, length in __encodingcodes], dtype=numpy.int64)
+        __batchtables['lengths'] = numpy.array([length for code, length in __encodingcodes], dtype=numpy.int64)
+        # Every table entry emits a variable amount of bytes, so pad them all out
+        # to the widest entry and keep the real count separately
+        width = max(len(decoded) for decoded, state in __decodingtable)
+        emitted = numpy.zeros((len(__decodingtable), width), dtype=numpy.uint8)
+        for index, (decoded, state) in enumerate(__decodingtable):
+            emitted[index, :len(decoded)] = tuple(decoded)
+        __batchtables['emitted'] = emitted
+        __batchtables['emittedcounts'] = numpy.array([len(decoded) for decoded, state in __decodingtable], dtype=numpy.int64)
+        __batchtables['states'] = numpy.array([state for decoded, state in __decodingtable], dtype=numpy.int64)
+    return __batchtables
+
+
+# Encodes a list of packets and returns a list of the encoded packets
+# - The output is identical to calling encode() on every packet, but the code
+# lookups, bit offsets and bit packing are done for the whole batch at once
+def encode_batch(rawpackets):
+    if numpy is None or len(rawpackets) < ENCODE_BATCH_MINIMUM:
+        return [encode(rawdata) for rawdata in rawpackets]
+    tables = __get_batch_tables()
+
+    lengths = numpy.fromiter((len(rawdata) for rawdata in rawpackets), dtype=numpy.int64, count=len(rawpackets))
+    data = numpy.frombuffer(b''.join(rawpackets), dtype=numpy.uint8)
+    if data.size == 0:
+        return [bytearray() for rawdata in rawpackets]
+    codelengths = tables['lengths'][data]
+
+    # Total up the bits for every packet to find out which ones get encoded
+    starts = numpy.cumsum(lengths) - lengths
+    nonempty = lengths > 0
+    totalbits = numpy.zeros(len(rawpackets), dtype=numpy.int64)
+    totalbits[nonempty] = numpy.add.reduceat(codelengths, starts[nonempty])
+    encoded = nonempty & (totalbits < (lengths - 1) * 8)
+
+    # Work out where every packet goes in the output, each one gets a header
+    # byte followed by its bits rounded up to a whole byte
+    outlengths = numpy.where(encoded, 1 + ((totalbits + 7) >> 3), 0)
+    outstarts = numpy.cumsum(outlengths) - outlengths
+    output = numpy.zeros(0, dtype=numpy.uint8)
+    if encoded.any():
+        symbolmask = numpy.repeat(encoded, lengths)
+        symbols = data[symbolmask]
+        symbollengths = codelengths[symbolmask]
+        symbolcodes = tables['codes'][symbols]
+
+        # The bit offset of every symbol within its own packet
+        symbolstarts = numpy.cumsum(symbollengths) - symbollengths
+        packetbits = totalbits[encoded]
+        packetbitstarts = numpy.cumsum(packetbits) - packetbits
+        symbolcounts = lengths[encoded]
+        symboldests = symbolstarts - numpy.repeat(packetbitstarts, symbolcounts) + \
+            numpy.repeat((outstarts[encoded] + 1) * 8, symbolcounts)
+
+        # Shift every code into place, a code is at most 10 bits so it covers at
+        # most three output bytes. Codes never share bits, so summing all the
+        # pieces that land on a byte is the same as ORing them together
+        shiftedcodes = symbolcodes << (symboldests & 7)
+        destbytes = symboldests >> 3
+        pieces = numpy.concatenate((shiftedcodes & 0xFF, (shiftedcodes >> 8) & 0xFF, shiftedcodes >> 16))
+        piecebytes = numpy.concatenate((destbytes, destbytes + 1, destbytes + 2))
+        output = numpy.bincount(piecebytes, weights=pieces, minlength=int(outlengths.sum()) + 2).astype(numpy.uint8)
+        output[outstarts[encoded]] = (-packetbits) & 7
+
+    output = output.tobytes()
+    encodedpackets = []
+    for rawdata, isencoded, isnonempty, start, length in zip(rawpackets, encoded.tolist(), nonempty.tolist(),
+                                                             outstarts.tolist(), outlengths.tolist()):
+        if isencoded:
+            encodedpackets.append(bytearray(output[start:start + length]))
+        elif isnonempty:
+            encodeddata = bytearray(1)
+            encodeddata[0] = 0xFF  # Compatibility issues with Zan/ST
+            encodeddata.extend(rawdata)
+            encodedpackets.append(encodeddata)
+        else:
+            encodedpackets.append(bytearray())
+    return encodedpackets
+
+
+# Decodes a list of packets and returns a list of the decoded packets
+# - The output is identical to calling decode() on every packet. Every packet is
+# stepped through the decoding table together, one input byte per step
+def decode_batch(encodedpackets):
+    if numpy is None or len(encodedpackets) < DECODE_BATCH_MINIMUM:
+        return [decode(encodeddata) for encodeddata in encodedpackets]
+    tables = __get_batch_tables()
+
+    # Anything unencoded or empty is handled right away
+    decodedpackets = [None] * len(encodedpackets)
+    pending = []
+    for index, encodeddata in enumerate(encodedpackets):
+        if len(encodeddata) <= 0:
+            decodedpackets[index] = bytearray()
+        elif encodeddata[0] == 0xFF:
+            decodedpackets[index] = bytearray(encodeddata[1:])
+        elif ((len(encodeddata) - 1) * 8) - encodeddata[0] <= 0:
+            decodedpackets[index] = bytearray()
+        else:
+            pending.append(index)
+    if not pending:
+        return decodedpackets
+
+    # Sort the packets longest first, so the packets still being decoded at
+    # any step are always at the front
+    numbits = numpy.array([((len(encodedpackets[i]) - 1) * 8) - encodedpackets[i][0] for i in pending], dtype=numpy.int64)
+    order = numpy.argsort(-(numbits >> 3), kind='stable')
+    pending = [pending[i] for i in order]
+    numbits = numbits[order]
+    numbytes = numbits >> 3
+
+    # Lay out the whole bytes of every packet as rows of a matrix
+    maxbytes = int(numbytes[0])
+    rows = len(pending)
+    matrix = numpy.zeros((rows, maxbytes), dtype=numpy.int64)
+    if maxbytes > 0:
+        flat = numpy.frombuffer(b''.join(bytes(encodedpackets[i][1:n + 1]) for i, n in zip(pending, numbytes.tolist())), dtype=numpy.uint8)
+        rowstarts = numpy.cumsum(numbytes) - numbytes
+        rowindices = numpy.repeat(numpy.arange(rows), numbytes)
+        matrix[rowindices, numpy.arange(flat.size) - rowstarts[rowindices]] = flat
+
+    # Every step writes the whole padded table entry and then only advances by
+    # the real count, the padding is overwritten by the next step or cut off
+    emitted = tables['emitted']
+    emittedcounts = tables['emittedcounts']
+    nextstates = tables['states']
+    columns = numpy.arange(emitted.shape[1])
+    rowindices = numpy.arange(rows)[:, None]
+    matrix = numpy.ascontiguousarray(matrix.T)
+    state = numpy.zeros(rows, dtype=numpy.int64)
+    output = numpy.zeros((rows, (maxbytes + 1) * emitted.shape[1]), dtype=numpy.uint8)
+    outpositions = numpy.zeros(rows, dtype=numpy.int64)
+    active = rows
+    for step in range(maxbytes):
+        while numbytes[active - 1] <= step:
+            active -= 1
+        entries = state[:active] | matrix[step, :active]
+        output[rowindices[:active], outpositions[:active, None] + columns] = emitted[entries]
+        outpositions[:active] += emittedcounts[entries]
+        state[:active] = nextstates[entries]
+
+    # Finish off the partially filled last byte of every packet
+    rowlength = output.shape[1]
+    output = output.tobytes()
+    for row, (index, length, bits, endstate) in enumerate(zip(pending, outpositions.tolist(), numbits.tolist(), state.tolist())):
+        decodeddata = bytearray(output[row * rowlength:row * rowlength + length])
+        if bits & 7:
+            decoded, node = __walk_bits(__decodingnodes[endstate >> 8], encodedpackets[index][(bits >> 3) + 1], bits & 7)
+            decodeddata += decoded
+        decodedpackets[index] = decodeddata
+    return decodedpackets
+
+
 # Initialize huffman if it's not working already
 if not __is_initialized:
     __init_huffman()
@@ -0,0 +1,115 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import net.serverquery
+
+# RCON commands that change what a query would return, running one of these
+# on a server drops its cached query
+STATE_CHANGING_COMMANDS = ('map', 'changemap', 'kick', 'kickfromgame', 'forcespec', 'addbot', 'removebots',
+                           'sv_maxclients', 'sv_maxplayers', 'fraglimit', 'timelimit', 'pointlimit', 'duellimit',
+                           'winlimit', 'sv_hostname')
+
+# The RCON commands of those that change the map, which is when a delta query's
+# snapshot of a server has to be thrown away too
+MAP_CHANGING_COMMANDS = ('map', 'changemap')
+
+
+# Checks if an RCON command changes the server's map
+def changes_map(command):
+    words = command.split(None, 1)
+    return bool(words) and words[0].lower() in MAP_CHANGING_COMMANDS
+
+
+# A query that's been sent, which anyone else asking for the same server waits on
+class _PendingQuery:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.invalidated = False
+
+
+# Caches server query results for each (ip, port) for a short time
+# - Zandronum only answers so many launcher queries before it tells us we're
+# flooding, so everything that wants a server's status should go through here
+# instead of calling perform_server_query itself
+# - If a query for a server is already on its way, anyone else asking for that
+# server waits for its result instead of sending another one
+# - Failed queries (None) aren't cached
+class QueryCache:
+    def __init__(self, ttl, query_function=net.serverquery.perform_server_query):
+        self._ttl = ttl
+        self._query_function = query_function
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._pending = {}
+
+    # Returns the cached result for the server, or queries it if there is none
+    def query(self, ip, port):
+        key = (ip, port)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+            pending = self._pending.get(key)
+            is_owner = pending is None
+            if is_owner:
+                pending = _PendingQuery()
+                self._pending[key] = pending
+        if not is_owner:
+            pending.event.wait()
+            return pending.result
+        result = None
+        try:
+            result = self._query_function(ip, port)
+        finally:
+            with self._lock:
+                del self._pending[key]
+                if result is not None and not pending.invalidated:
+                    self._entries[key] = (time.monotonic() + self._ttl, result)
+            pending.result = result
+            pending.event.set()
+        return result
+
+    # Stores a result we got some other way, like from a poller sweep
+    def put(self, ip, port, result):
+        if result is None:
+            return
+        with self._lock:
+            self._entries[(ip, port)] = (time.monotonic() + self._ttl, result)
+
+    # Drops the cached result for a server, a query that's already on its way
+    # still gets returned to whoever is waiting but isn't cached
+    def invalidate(self, ip, port):
+        key = (ip, port)
+        with self._lock:
+            self._entries.pop(key, None)
+            pending = self._pending.get(key)
+            if pending is not None:
+                pending.invalidated = True
+
+    # Drops the cached result for a server if the RCON command changes its state
+    def invalidate_after_command(self, ip, port, command):
+        words = command.split(None, 1)
+        if words and words[0].lower() in STATE_CHANGING_COMMANDS:
+            self.invalidate(ip, port)
+
+    # Drops every expired entry
+    def prune(self):
+        now = time.monotonic()
+        with self._lock:
+            for key in [key for key, (expiry, result) in self._entries.items() if expiry <= now]:
+                del self._entries[key]
@@ -13,9 +13,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import hashlib
-import socket
-import net.huffman
+import threading
+import time
+import net.udptransport
+from net.bytebuffer import ByteBuffer
 
 
 # Enumeration of different server rcon responses
@@ -37,12 +40,36 @@ SVRCU_PLAYERDATA = 0
 SVRCU_ADMINCOUNT = 1
 SVRCU_MAP = 2
 
+# The replies each step of a login waits for, anything else the server sends
+# meanwhile (like a pushed update) isn't taken for one
+BEGIN_CONNECTION_REPLIES = (SVRC_SALT, SVRC_OLDPROTOCOL, SVRC_BANNED)
+PASSWORD_REPLIES = (SVRC_LOGGEDIN, SVRC_INVALIDPASSWORD)
+
 # Zan protocol version
 ZAN_PROTOCOL_VERSION = 3
 
 # A quick lookup table for hex characters
 HEX_LOOKUP = ('0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'a', 'b', 'c', 'd', 'e', 'f')
 
+# How long to wait for each reply from the server (seconds)
+RCON_TIMEOUT = 5.0
+
+# How often a logged in session sends a pong so the server doesn't drop it (seconds)
+PONG_INTERVAL = 5.0
+
+# How many times a session tries to log in before a command fails
+LOGIN_ATTEMPTS = 2
+
+# What happened to a broadcast command on each server
+BROADCAST_SENT = 'sent'
+BROADCAST_FAILED = 'failed'
+BROADCAST_TIMEOUT = 'timeout'
+
+# The defaults for broadcasting: how many servers get sent to at once, and how
+# long the whole broadcast can take (seconds)
+DEFAULT_BROADCAST_WORKERS = 32
+DEFAULT_BROADCAST_TIMEOUT = 10.0
+
 
 # Converst a bytearray to a string
 def __bytes_to_hexstring(bytearr):
@@ -53,68 +80,280 @@ def __bytes_to_hexstring(bytearr):
     return hexstring
 
 
-# Sends a command to the client, will raise an exception if it times out (10 sec)
+# Creates the packet that starts a login
+def make_begin_connection_packet():
+    packet = ByteBuffer(True, capacity=2)
+    packet.put_byte(CLRC_BEGINCONNECTION)
+    packet.put_byte(ZAN_PROTOCOL_VERSION)
+    return packet
+
+
+# Creates the login packet from the salt the server sent us
+def make_password_packet(saltdata, rconpass):
+    # To generate the login, concatenate the salt and password bytes
+    logindata = bytearray()
+    logindata.extend(saltdata)
+    logindata.extend(rconpass.encode('ascii'))
+
+    # Then hash the salt/pass combo
+    md5 = hashlib.md5()
+    md5.update(logindata)
+    hashlogin = md5.digest()
+
+    # Now make the password header + the hashed login as hex
+    packet = ByteBuffer(True, capacity=1 + (len(hashlogin) * 2))
+    packet.put_byte(CLRC_PASSWORD)
+    packet.put_string(__bytes_to_hexstring(hashlogin), 'ascii')
+    return packet
+
+
+# Creates the packet that runs a command
+def make_command_packet(command):
+    commandbytes = command.encode('ascii')
+    packet = ByteBuffer(True, capacity=1 + len(commandbytes))
+    packet.put_byte(CLRC_COMMAND)
+    packet.put_bytes(commandbytes)
+    return packet
+
+
+# Creates the keepalive packet a logged in client sends
+def make_pong_packet():
+    packet = ByteBuffer(True, capacity=1)
+    packet.put_byte(CLRC_PONG)
+    return packet
+
+
+# Creates the packet that logs out
+def make_disconnect_packet():
+    packet = ByteBuffer(True, capacity=1)
+    packet.put_byte(CLRC_DISCONNECT)
+    return packet
+
+
+# Sends a command to the server through the shared transport, logging in
+# just for it, returns whether it got logged in and sent the command
 # NOTE: This does blocking, move to its own thread in the future
 def send_command(ip, port, rconpass, command):
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            # Set the socket values
-            s.setblocking(True)
-            s.settimeout(5.0)
-
-            # Create a byte array with the required headers
-            rawdata = bytearray()
-            rawdata.append(CLRC_BEGINCONNECTION)
-            rawdata.append(ZAN_PROTOCOL_VERSION)
-            encodeddata = net.huffman.encode(rawdata)
-            s.sendto(encodeddata, (ip, port))
-
-            # Wait for the response
-            data, address = s.recvfrom(64)
-            decodeddata = net.huffman.decode(data)
-            if decodeddata[0] != SVRC_SALT:
-                print("Header not a salt:", decodeddata[0])
-                return False
+    transport = net.udptransport.get_transport()
+    address = net.udptransport.resolve(ip, port)
+    # The server knows us by our address, so only one login to it can be going on at once
+    with transport.exclusive(address):
+        if perform_login(transport, address, rconpass) is None:
+            return False
+        # Send our command now
+        try:
+            transport.send(address, make_command_packet(command).get_view())
+        except OSError as e:
+            print("Failed to send rcon command", command, "to", ip, ":", port, ":", e)
+            return False
+    return True
 
-            # Extract the salt by tossing away header and null terminator
-            saltdata = decodeddata[1:33]
 
-            # To generate the login, concatenate the salt and password bytes
-            logindata = bytearray()
-            logindata.extend(saltdata)
-            logindata.extend(rconpass.encode('ascii'))
+# Runs the login handshake with the server through the transport, returns the
+# decoded SVRC_LOGGEDIN reply or None (after printing why) if it failed
+def perform_login(transport, address, rconpass):
+    decodeddata = transport.request(address, net.udptransport.KIND_RCON, make_begin_connection_packet().get_view(),
+                                    RCON_TIMEOUT, BEGIN_CONNECTION_REPLIES)
+    if decodeddata is None:
+        print("Socket timed out attempting to log in to rcon on", address[0], ":", address[1])
+        return None
+    if decodeddata[0] != SVRC_SALT:
+        print("Header not a salt:", decodeddata[0])
+        return None
+    decodeddata = transport.request(address, net.udptransport.KIND_RCON,
+                                    make_password_packet(decodeddata[1:33], rconpass).get_view(), RCON_TIMEOUT,
+                                    PASSWORD_REPLIES)
+    if decodeddata is None:
+        print("Socket timed out attempting to log in to rcon on", address[0], ":", address[1])
+        return None
+    if decodeddata[0] != SVRC_LOGGEDIN:
+        print("Failure logging in:", decodeddata[0])
+        return None
+    return decodeddata
 
-            # Then hash the salt/pass combo
-            md5 = hashlib.md5()
-            md5.update(logindata)
-            hashlogin = md5.digest()
 
-            # Then convert into hex
-            hashedhex = __bytes_to_hexstring(hashlogin)
+# A logged in RCON connection to one server that's kept around, so a command
+# only takes one datagram instead of a whole login
+# - It logs in again the next time it's used if the login failed, the server
+# said our protocol is too old or logged us out, sending failed, or a command
+# got nothing back within RCON_TIMEOUT. Zandronum echoes every command to its
+# RCON clients, so silence after one means the server forgot us (it restarted)
+# - An idle session stays logged in however quiet the server is, since
+# Zandronum sends nothing to an idle RCON client
+# - Everything the server sends that isn't a login reply goes to the session
+# through the transport (see handle_datagram), and on to the listener if it
+# has one. The listener is given the login reply as well, since it carries
+# the same updates
+class RCONSession:
+    def __init__(self, transport, address, rconpass):
+        self.transport = transport
+        self.address = address
+        self.rconpass = rconpass
+        self.is_logged_in = False
+        self.last_sent = 0.0
+        self.last_heard = 0.0
+        self.unanswered_since = None  # When the oldest command nothing came back for was sent
+        self.listener = None
+        self._lock = threading.Lock()
+        transport.subscribe(address, net.udptransport.KIND_RCON, self.handle_datagram)
 
-            # Now send the password header + the payload
-            hashedlogin = bytearray()
-            hashedlogin.append(CLRC_PASSWORD)
-            hashedlogin.extend(hashedhex.encode('ascii'))
+    # Sends a command, logging in first if we aren't, returns whether it was sent
+    def send_command(self, command):
+        with self._lock:
+            if not self._check_logged_in() and not self._login():
+                return False
+            # Set before sending, the echo can come back before send returns
+            if self.unanswered_since is None:
+                self.unanswered_since = time.monotonic()
+            try:
+                self._send(make_command_packet(command))
+            except OSError as e:
+                print("Failed to send rcon command", command, "to", self.address[0], ":", self.address[1], ":", e)
+                self.is_logged_in = False
+                return False
+        return True
 
-            # Encode and send
-            encodedhashedlogin = net.huffman.encode(hashedlogin)
-            s.sendto(encodedhashedlogin, (ip, port))
+    # Logs in if we aren't, returns whether we are
+    def ensure_logged_in(self):
+        with self._lock:
+            return self._check_logged_in() or self._login()
 
-            # Wait for the response
-            data, address = s.recvfrom(2048) # Hopefully this holds whatever is sent, though it should be < 576
-            decodeddata = net.huffman.decode(data)
-            if decodeddata[0] != SVRC_LOGGEDIN:
-                print("Failure logging in:", decodeddata[0])
-                return False
+    # Sends a pong if we've been quiet for a while, so the server keeps us,
+    # or marks us logged out if a command went unanswered
+    def keep_alive(self):
+        with self._lock:
+            if self._check_logged_in() and time.monotonic() - self.last_sent >= PONG_INTERVAL:
+                try:
+                    self._send(make_pong_packet())
+                except OSError:
+                    self.is_logged_in = False
+
+    # Logs out and stops listening to the server
+    def close(self):
+        with self._lock:
+            if self.is_logged_in:
+                try:
+                    self._send(make_disconnect_packet())
+                except OSError:
+                    pass
+                self.is_logged_in = False
+        self.transport.unsubscribe(self.address, net.udptransport.KIND_RCON)
 
-            # Send our command now
-            commandtosendbytes = bytearray()
-            commandtosendbytes.append(CLRC_COMMAND)
-            commandtosendbytes.extend(command.encode('ascii'))
-            encodedcommandtosend = net.huffman.encode(commandtosendbytes)
-            s.sendto(encodedcommandtosend, (ip, port))
-    except socket.timeout:
-        print("Socket timed out attempting to send rcon command", command, "to", ip, ":", port)
+    # Called by the transport with everything from the server we weren't waiting on
+    def handle_datagram(self, decodeddata):
+        if not decodeddata:
+            return
+        self.last_heard = time.monotonic()
+        self.unanswered_since = None
+        if decodeddata[0] in (SVRC_OLDPROTOCOL, SVRC_BANNED, SVRC_INVALIDPASSWORD):
+            self.is_logged_in = False
+        listener = self.listener
+        if listener is not None:
+            listener(decodeddata)
+
+    # Must hold the lock, returns whether we're still logged in
+    def _check_logged_in(self):
+        unanswered_since = self.unanswered_since
+        if self.is_logged_in and unanswered_since is not None and time.monotonic() - unanswered_since >= RCON_TIMEOUT:
+            print("Rcon command to", self.address[0], ":", self.address[1], "went unanswered, logging in again")
+            self.is_logged_in = False
+        return self.is_logged_in
+
+    # Must hold the lock
+    def _login(self):
+        with self.transport.exclusive(self.address):
+            for attempt in range(LOGIN_ATTEMPTS):
+                decodeddata = perform_login(self.transport, self.address, self.rconpass)
+                if decodeddata is not None:
+                    self.is_logged_in = True
+                    self.last_sent = self.last_heard = time.monotonic()
+                    self.unanswered_since = None
+                    listener = self.listener
+                    if listener is not None:
+                        listener(decodeddata)
+                    return True
         return False
-    return True
+
+    def _send(self, packet):
+        self.transport.send(self.address, packet.get_view())
+        self.last_sent = time.monotonic()
+
+
+# Keeps one RCONSession per server and a thread that sends their pongs
+class RCONSessionPool:
+    def __init__(self, transport=None):
+        self._transport = transport if transport is not None else net.udptransport.get_transport()
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._keep_alive)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Returns the session for the server, making it if there isn't one or the
+    # password changed
+    def get_session(self, ip, port, rconpass):
+        address = net.udptransport.resolve(ip, port)
+        with self._lock:
+            session = self._sessions.get(address)
+            if session is not None and session.rconpass == rconpass:
+                return session
+            if session is not None:
+                session.close()
+            session = RCONSession(self._transport, address, rconpass)
+            self._sessions[address] = session
+            return session
+
+    # Sends a command to the server through its session, returns whether it was sent
+    def send_command(self, ip, port, rconpass, command):
+        return self.get_session(ip, port, rconpass).send_command(command)
+
+    # Logs out of the server and forgets its session, for when it goes down
+    def remove(self, ip, port):
+        with self._lock:
+            session = self._sessions.pop(net.udptransport.resolve(ip, port), None)
+        if session is not None:
+            session.close()
+
+    # Logs out of every server
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+    def _keep_alive(self):
+        while not self._closed.wait(1.0):
+            with self._lock:
+                sessions = list(self._sessions.values())
+            for session in sessions:
+                session.keep_alive()
+
+
+# Sends the command to every (ip, port, rconpass) in targets through the pool
+# at the same time, returns a dict of (ip, port) -> BROADCAST_SENT,
+# BROADCAST_FAILED or BROADCAST_TIMEOUT
+# - At most max_workers servers are being sent to at once, and this returns
+# after timeout seconds no matter how many are left, those count as timed out
+def broadcast_command(pool, targets, command, timeout=DEFAULT_BROADCAST_TIMEOUT,
+                      max_workers=DEFAULT_BROADCAST_WORKERS):
+    targets = list(targets)
+    if not targets:
+        return {}
+    results = {}
+    executor = concurrent.futures.ThreadPoolExecutor(min(max_workers, len(targets)))
+    try:
+        futures = {executor.submit(pool.send_command, ip, port, rconpass, command): (ip, port)
+                   for ip, port, rconpass in targets}
+        done, not_done = concurrent.futures.wait(futures, timeout)
+        for future in done:
+            sent = future.exception() is None and future.result()
+            results[futures[future]] = BROADCAST_SENT if sent else BROADCAST_FAILED
+        for future in not_done:
+            results[futures[future]] = BROADCAST_TIMEOUT
+    finally:
+        # Whatever's still running finishes on its own, nobody waits for it
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
@@ -0,0 +1,197 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import threading
+import time
+import net.rcon
+import net.udptransport
+from net.bytebuffer import ByteBuffer, ByteBufferException
+
+# The events a listener gets, along with the new value
+EVENT_PLAYERS = 'players'  # A list of player names
+EVENT_ADMINCOUNT = 'admincount'  # How many RCON clients are logged in
+EVENT_MAP = 'map'  # The name of the new map
+EVENT_MESSAGE = 'message'  # A line of the server's console
+
+# The LiveServerState field each event (other than EVENT_MESSAGE) sets
+STATE_FIELDS = {EVENT_PLAYERS: 'players', EVENT_ADMINCOUNT: 'admincount', EVENT_MAP: 'mapname'}
+
+# How many console lines are kept for each server
+MESSAGE_HISTORY = 50
+
+# How often the servers that we got logged out of get logged back into (seconds)
+RELOGIN_INTERVAL = 5.0
+
+
+# What a server's RCON updates last told us
+class LiveServerState:
+    __slots__ = ('hostname', 'players', 'admincount', 'mapname', 'messages', 'last_update')
+
+    def __init__(self):
+        self.hostname = None
+        self.players = []
+        self.admincount = 0
+        self.mapname = None
+        self.messages = collections.deque(maxlen=MESSAGE_HISTORY)
+        self.last_update = None
+
+
+# Reads one SVRCU_ update (its type and what follows it), returns the
+# (event, value) or None if it's not a type we know
+def read_update(bb):
+    updatetype = bb.get_byte()
+    if updatetype == net.rcon.SVRCU_PLAYERDATA:
+        return EVENT_PLAYERS, [bb.get_string_null_terminated() for i in range(bb.get_byte())]
+    if updatetype == net.rcon.SVRCU_ADMINCOUNT:
+        return EVENT_ADMINCOUNT, bb.get_byte()
+    if updatetype == net.rcon.SVRCU_MAP:
+        return EVENT_MAP, bb.get_string_null_terminated()
+    return None
+
+
+# Parses a (decoded) datagram the server sent over RCON into a list of
+# (event, value), along with the hostname if it's the login reply
+# - The login reply is the protocol version, the hostname, every update and
+# then the last lines of the console
+def parse_datagram(decodeddata):
+    bb = ByteBuffer(True, decodeddata)
+    events = []
+    hostname = None
+    try:
+        header = bb.get_byte()
+        if header == net.rcon.SVRC_UPDATE:
+            event = read_update(bb)
+            if event is not None:
+                events.append(event)
+        elif header == net.rcon.SVRC_MESSAGE:
+            events.append((EVENT_MESSAGE, bb.get_string_null_terminated()))
+        elif header == net.rcon.SVRC_LOGGEDIN:
+            bb.get_byte()  # Protocol version
+            hostname = bb.get_string_null_terminated()
+            for i in range(bb.get_byte()):
+                event = read_update(bb)
+                if event is None:
+                    break  # We can't know how long an update we don't know is
+                events.append(event)
+            else:
+                for i in range(bb.get_byte()):
+                    events.append((EVENT_MESSAGE, bb.get_string_null_terminated()))
+    except ByteBufferException as e:
+        print("ByteBuffer extraction failed:", e)
+    return events, hostname
+
+
+# Stays logged in to servers over RCON and keeps their live state from the
+# updates they push to us, so their players and map are known without
+# sending launcher queries
+# - Listeners are called as listener(address, event, value) from the UDP
+# transport's thread, so they have to be quick. They're only called when a
+# value actually changed, the login reply's snapshot and updates that repeat
+# what we already know don't count, and neither do the console lines the
+# login reply carries
+# - A thread does the logging in, both the first time and back into servers
+# we got logged out of, so watch() doesn't wait on the server
+class RCONMonitor:
+    def __init__(self, pool):
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._states = {}  # (ip, port) -> LiveServerState
+        self._sessions = {}  # (ip, port) -> RCONSession
+        self._listeners = []
+        self._closed = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._relogin)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    # Starts following the server, the login happens on the monitor's thread
+    def watch(self, ip, port, rconpass):
+        session = self._pool.get_session(ip, port, rconpass)
+        address = session.address
+        with self._lock:
+            self._states[address] = LiveServerState()
+            self._sessions[address] = session
+        session.listener = lambda decodeddata: self._handle(address, decodeddata)
+        self._wakeup.set()
+
+    # Stops following the server and forgets its state
+    def unwatch(self, ip, port):
+        address = net.udptransport.resolve(ip, port)
+        with self._lock:
+            session = self._sessions.pop(address, None)
+            self._states.pop(address, None)
+        if session is not None:
+            session.listener = None
+
+    # Returns the LiveServerState of the server, or None if it's not watched
+    def get_state(self, ip, port):
+        with self._lock:
+            return self._states.get(net.udptransport.resolve(ip, port))
+
+    def close(self):
+        self._closed.set()
+        self._wakeup.set()
+        with self._lock:
+            for session in self._sessions.values():
+                session.listener = None
+            self._sessions.clear()
+            self._states.clear()
+
+    def _handle(self, address, decodeddata):
+        events, hostname = parse_datagram(decodeddata)
+        changes = []
+        with self._lock:
+            state = self._states.get(address)
+            if state is None:
+                return
+            # A login reply is a snapshot of everything, the first one only
+            # seeds the state and later ones only tell about what changed
+            is_snapshot = hostname is not None
+            is_seeded = state.last_update is not None
+            if is_snapshot:
+                state.hostname = hostname
+                state.messages.clear()
+            for event, value in events:
+                if event == EVENT_MESSAGE:
+                    state.messages.append(value)
+                    if not is_snapshot:
+                        changes.append((event, value))
+                    continue
+                field = STATE_FIELDS[event]
+                if getattr(state, field) == value:
+                    continue
+                setattr(state, field, value)
+                if is_seeded or not is_snapshot:
+                    changes.append((event, value))
+            state.last_update = time.monotonic()
+        for event, value in changes:
+            for listener in self._listeners:
+                listener(address, event, value)
+
+    def _relogin(self):
+        while True:
+            self._wakeup.wait(RELOGIN_INTERVAL)
+            self._wakeup.clear()
+            if self._closed.is_set():
+                return
+            with self._lock:
+                sessions = [session for session in self._sessions.values() if not session.is_logged_in]
+            for session in sessions:
+                if not session.ensure_logged_in():
+                    print("Could not log in to rcon on", session.address[0], ":", session.address[1], ", retrying later")
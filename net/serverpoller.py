@@ -0,0 +1,112 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import socket
+import net.huffman
+import net.serverquery
+
+
+# How long to wait for a single server to reply (seconds)
+DEFAULT_QUERY_TIMEOUT = 5.0
+
+# How many queries can be waiting on a reply at once
+DEFAULT_MAX_IN_FLIGHT = 64
+
+
+# Receives every reply on the one socket a sweep uses, and hands them to
+# whoever is waiting on the address they came from
+class _PollerProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.waiting = {}
+
+    def datagram_received(self, data, address):
+        future = self.waiting.pop(address[:2], None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    # Things like ICMP port unreachable end up here, the query just times out
+    def error_received(self, exc):
+        pass
+
+
+# Queries every address concurrently from a single socket and returns a dict of
+# address -> ServerQueryResult (or None if it timed out or couldn't be parsed)
+# - Replies are matched to queries by their source address, so addresses have
+# to be numeric (ip, port) tuples. Every query gets its own timeout and at most
+# max_in_flight are waiting on a reply at once, which means a sweep takes about
+# as long as the slowest server instead of all of them added together
+# - With a DeltaTracker, servers are only asked for what changed since their
+# last full reply, and the ones whose map changed get asked again for everything
+async def poll_servers(addresses, timeout=DEFAULT_QUERY_TIMEOUT, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                       delta_tracker=None):
+    addresses = list(dict.fromkeys(addresses))
+    if not addresses:
+        return {}
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(_PollerProtocol, family=socket.AF_INET)
+    semaphore = asyncio.Semaphore(max_in_flight)
+    querypackets = {}
+
+    async def query(address, flags):
+        querypacket = querypackets.get(flags)
+        if querypacket is None:
+            querypacket = querypackets[flags] = net.serverquery.make_query_packet(flags)
+        async with semaphore:
+            future = loop.create_future()
+            protocol.waiting[address] = future
+            transport.sendto(querypacket, address)
+            try:
+                data = await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                protocol.waiting.pop(address, None)
+        return net.serverquery.parse_server_query(net.huffman.decode(data))
+
+    # Like perform_delta_server_query, a server that doesn't answer gets its
+    # full query on the next sweep, so a sweep still takes about one timeout
+    async def delta_query(address):
+        flags = delta_tracker.flags_for(address)
+        reply = await query(address, flags)
+        if reply is None:
+            delta_tracker.invalidate(address)
+            return None
+        result = delta_tracker.merge(address, flags, reply)
+        if result is None and flags != net.serverquery.SQF_FULL_FLAGS:
+            fullflags = net.serverquery.SQF_FULL_FLAGS
+            result = delta_tracker.merge(address, fullflags, await query(address, fullflags))
+        return result
+
+    try:
+        if delta_tracker is None:
+            results = await asyncio.gather(*(query(address, net.serverquery.SQF_DESIRED_FLAGS)
+                                             for address in addresses))
+        else:
+            results = await asyncio.gather(*(delta_query(address) for address in addresses))
+    finally:
+        transport.close()
+    return dict(zip(addresses, results))
+
+
+# Queries every running server we're hosting in one sweep, returns a dict of
+# port -> ServerQueryResult (or None)
+def sweep_servers(doomhost):
+    ports = [server.port for server in list(doomhost.servers) if server.status == server.SERVER_RUNNING]
+    results = asyncio.run(poll_servers([(doomhost.query_ip, port) for port in ports],
+                                       doomhost.settings['advanced']['query_timeout'],
+                                       doomhost.settings['advanced']['query_max_in_flight'],
+                                       doomhost.query_delta_tracker))
+    return {address[1]: result for address, result in results.items()}
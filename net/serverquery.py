@@ -14,10 +14,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import socket
-import struct
+import threading
+import time
 import net.huffman
-from net.bytebuffer import ByteBuffer, ByteBufferException
+import net.udptransport
+from net.bytebuffer import ByteBuffer, ByteBufferException, Schema
 
 
 LAUNCHER_CHALLENGE = 199
@@ -55,6 +56,44 @@ SQF_SECURITY_SETTINGS = 0x10000000
 SQF_DESIRED_FLAGS = SQF_MAPNAME | SQF_MAXCLIENTS | SQF_MAXPLAYERS | SQF_PWADS | SQF_GAMETYPE | SQF_GAMENAME | \
                     SQF_IWAD | SQF_GAMESKILL | SQF_BOTSKILL | SQF_LIMITS | SQF_TEAMDAMAGE | SQF_ALL_DMFLAGS
 
+# The information that changes while a server is running, which is all that gets
+# asked for between full refreshes when polling with a DeltaTracker
+# (team info needs the number of teams to be parsed)
+SQF_VOLATILE_FLAGS = SQF_MAPNAME | SQF_NUMPLAYERS | SQF_PLAYERDATA | SQF_TEAMINFO_NUMBER | SQF_TEAMINFO_SCORE
+
+# What gets asked for on a full refresh
+SQF_FULL_FLAGS = SQF_DESIRED_FLAGS | SQF_VOLATILE_FLAGS
+
+# The result fields each flag fills in, team info is handled on its own since
+# the name, color and score of a team come from different flags
+SQF_RESULT_FIELDS = (
+    (SQF_NAME, ('name',)),
+    (SQF_URL, ('url',)),
+    (SQF_EMAIL, ('email',)),
+    (SQF_MAPNAME, ('mapname',)),
+    (SQF_MAXCLIENTS, ('maxclients',)),
+    (SQF_MAXPLAYERS, ('maxplayers',)),
+    (SQF_PWADS, ('pwads',)),
+    (SQF_GAMETYPE, ('gamemode', 'is_instagib', 'is_buckshot')),
+    (SQF_GAMENAME, ('gamename',)),
+    (SQF_IWAD, ('iwad',)),
+    (SQF_FORCEPASSWORD, ('is_force_password',)),
+    (SQF_FORCEJOINPASSWORD, ('is_force_join_password',)),
+    (SQF_GAMESKILL, ('gameskill',)),
+    (SQF_BOTSKILL, ('botskill',)),
+    (SQF_DMFLAGS, ('_dmflags',)),
+    (SQF_LIMITS, ('fraglimit', 'timelimit', 'time_left_minutes', 'duellimit', 'pointlimit', 'winlimit')),
+    (SQF_TEAMDAMAGE, ('teamdamage',)),
+    (SQF_TEAMSCORES, ('teamscores',)),
+    (SQF_NUMPLAYERS, ('numplayers',)),
+    (SQF_PLAYERDATA, ('_players',)),
+    (SQF_TEAMINFO_NUMBER, ('_numteams',)),
+    (SQF_TESTING_SERVER, ('_is_testing_server', '_testing_binary')),
+    (SQF_DATA_MD5SUM, ('_data_md5sum',)),
+    (SQF_ALL_DMFLAGS, ('_dmflags',)),
+    (SQF_SECURITY_SETTINGS, ('_is_security_set',)),
+)
+
 # The gamemode enumeration
 GAMEMODE_COOPERATIVE = 0
 GAMEMODE_SURVIVAL = 1
@@ -80,161 +119,365 @@ GAMEMODE_STRING = ["COOPERATIVE", "SURVIVAL", "INVASION", "DEATHMATCH", "TEAMPLA
                      "DOMINATION"]
 
 
-# Performs a server query by asking for the information
-def perform_server_query(ip, port):
-    querybytes = struct.pack("<LLL", LAUNCHER_CHALLENGE, SQF_DESIRED_FLAGS, 0)  # Last param isn't needed
-    encodeddata = net.huffman.encode(querybytes)
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+# The query we send: the challenge, the fields we want and the time (which
+# isn't needed)
+QUERY_SCHEMA = Schema('LLL')
+
+# The start of every reply: the response header, the time we sent, the version
+# string and the flags for the fields that follow
+REPLY_HEADER_SCHEMA = Schema('llzl')
+
+# A player in the player data: name, score, ping, spectating, bot, team and the
+# minutes they've been in the server
+PLAYER_SCHEMA = Schema('zhhBBBB')
+
+# How long to wait for a reply (seconds)
+QUERY_TIMEOUT = 5.0
+
+
+# Creates the (unencoded) launcher query asking for the fields in the flags
+def __make_query(flags):
+    query = ByteBuffer(True, capacity=QUERY_SCHEMA.size)
+    query.put_record(QUERY_SCHEMA, (LAUNCHER_CHALLENGE, flags, 0))  # Last param isn't needed
+    return query.get_view()
+
+
+# Creates the encoded launcher query asking for the fields in the flags
+def make_query_packet(flags=SQF_DESIRED_FLAGS):
+    return net.huffman.encode(__make_query(flags))
+
+
+# Performs a server query through the shared transport by asking for the
+# information, returns a ServerQueryResult or None if it failed
+def perform_server_query(ip, port, flags=SQF_DESIRED_FLAGS):
+    decodeddata = net.udptransport.get_transport().request(net.udptransport.resolve(ip, port),
+                                                           net.udptransport.KIND_QUERY, __make_query(flags),
+                                                           QUERY_TIMEOUT)
+    if decodeddata is None:
+        print("Timeout when trying to perform a server query to", ip, port)
+        return None
+    return parse_server_query(decodeddata)
+
+
+# Parses the (decoded) reply to a server query, returns a ServerQueryResult or
+# None if the server refused us or the reply is corrupt
+# - Everything up to the player count is read now, the player data and what
+# comes after it is read the first time it's asked for
+def parse_server_query(decodeddata):
+    bb = ByteBuffer(True, decodeddata)
+    try:
+        # Go through the elements now, starting with the header
+        # The time gets discarded, we don't care
+        firstheader, querytime, versionstring, bitflags = bb.get_record(REPLY_HEADER_SCHEMA)
+        if firstheader != 5660023:  # If it's not this number, we're flooding or banned
+            return None
+        result = ServerQueryResult(versionstring, bitflags)
+
+        # Check what fields we're sent back
+        if bitflags & SQF_NAME:
+            result.name = bb.get_string_null_terminated()
+        if bitflags & SQF_URL:
+            result.url = bb.get_string_null_terminated()
+        if bitflags & SQF_EMAIL:
+            result.email = bb.get_string_null_terminated()
+        if bitflags & SQF_MAPNAME:
+            result.mapname = bb.get_string_null_terminated()
+        if bitflags & SQF_MAXCLIENTS:
+            result.maxclients = bb.get_byte()
+        if bitflags & SQF_MAXPLAYERS:
+            result.maxplayers = bb.get_byte()
+        if bitflags & SQF_PWADS:
+            numpwads = bb.get_byte()
+            result.pwads = [bb.get_string_null_terminated() for i in range(numpwads)]
+        if bitflags & SQF_GAMETYPE:
+            result.gamemode = bb.get_byte()
+            result.is_instagib = bb.get_byte() > 0
+            result.is_buckshot = bb.get_byte() > 0
+        if bitflags & SQF_GAMENAME:
+            result.gamename = bb.get_string_null_terminated()
+        if bitflags & SQF_IWAD:
+            result.iwad = bb.get_string_null_terminated()
+        if bitflags & SQF_FORCEPASSWORD:
+            result.is_force_password = bb.get_byte() > 0
+        if bitflags & SQF_FORCEJOINPASSWORD:
+            result.is_force_join_password = bb.get_byte() > 0
+        if bitflags & SQF_GAMESKILL:
+            result.gameskill = bb.get_byte()
+        if bitflags & SQF_BOTSKILL:
+            result.botskill = bb.get_byte()
+        if bitflags & SQF_DMFLAGS:
+            # Deprecated, these are in the SQF_ALL_DMFLAGS list as well
+            result._dmflags = [bb.get_int(), bb.get_int(), 0, bb.get_int(), 0]
+        if bitflags & SQF_LIMITS:
+            result.fraglimit = bb.get_short_unsigned()
+            result.timelimit = bb.get_short_unsigned()
+            if result.timelimit > 0:
+                result.time_left_minutes = bb.get_short_unsigned()  # Apparently this is only sent if the time limit > 0
+            result.duellimit = bb.get_short_unsigned()
+            result.pointlimit = bb.get_short_unsigned()
+            result.winlimit = bb.get_short_unsigned()
+        if bitflags & SQF_TEAMDAMAGE:
+            result.teamdamage = bb.get_float()
+        if bitflags & SQF_TEAMSCORES:
+            # Deprecated, this may not even be parsed right
+            result.teamscores = [bb.get_short(), bb.get_short()]
+        if bitflags & SQF_NUMPLAYERS:
+            result.numplayers = bb.get_byte()
+    except ByteBufferException as e:
+        print("ByteBuffer extraction failed:", e)
+        return None
+    result._parse_lock = threading.Lock()
+    result._remaining = bb
+    return result
+
+
+# A player from the player data of a query
+class PlayerInfo:
+    __slots__ = ('name', 'score', 'ping', 'is_spectator', 'is_bot', 'team', 'time_minutes')
+
+    def __init__(self, name, score, ping, is_spectator, is_bot, team, time_minutes):
+        self.name = name
+        self.score = score
+        self.ping = ping
+        self.is_spectator = is_spectator
+        self.is_bot = is_bot
+        self.team = team
+        self.time_minutes = time_minutes
+
+
+# A team from the team info of a query, anything the server didn't send is None
+class TeamInfo:
+    __slots__ = ('name', 'color', 'score')
+
+    def __init__(self):
+        self.name = None
+        self.color = None
+        self.score = None
+
+
+# The information a server sent back from a query, anything we didn't ask for
+# (or the server didn't send) is None
+# - The player data and everything after it (teams, testing server, MD5 sum, all
+# DM flags, security settings) is only parsed the first time one of them is used,
+# which can raise a ByteBufferException if that part of the reply is corrupt.
+# It's only ever parsed once, so after that they're left at whatever was read
+# - Results are shared between threads by the query cache, so the parsing is
+# done under a lock and the fields are only read once it's finished
+class ServerQueryResult:
+    __slots__ = ('version', 'flags', 'name', 'url', 'email', 'mapname', 'maxclients', 'maxplayers', 'pwads',
+                 'gamemode', 'is_instagib', 'is_buckshot', 'gamename', 'iwad', 'is_force_password',
+                 'is_force_join_password', 'gameskill', 'botskill', 'fraglimit', 'timelimit', 'time_left_minutes',
+                 'duellimit', 'pointlimit', 'winlimit', 'teamdamage', 'teamscores', 'numplayers',
+                 '_players', '_numteams', '_teams', '_is_testing_server', '_testing_binary', '_data_md5sum',
+                 '_dmflags', '_is_security_set', '_remaining', '_parse_lock')
+
+    def __init__(self, version, flags):
+        for field in self.__slots__:
+            setattr(self, field, None)
+        self.version = version
+        self.flags = flags
+
+    # Returns a new result with the fields of a reply that only asked for some
+    # fields (see SQF_VOLATILE_FLAGS) laid over the fields of this one, raises
+    # a ByteBufferException if either reply is corrupt
+    def merge(self, delta):
+        self._parse_remaining()
+        delta._parse_remaining()
+        merged = ServerQueryResult(delta.version, self.flags | delta.flags)
+        for field in self.__slots__:
+            setattr(merged, field, getattr(self, field))
+        merged.version = delta.version
+        merged.flags = self.flags | delta.flags
+        for flag, fields in SQF_RESULT_FIELDS:
+            if delta.flags & flag:
+                for field in fields:
+                    setattr(merged, field, getattr(delta, field))
+        if delta.flags & (SQF_TEAMINFO_NAME | SQF_TEAMINFO_COLOR | SQF_TEAMINFO_SCORE):
+            teams = []
+            for i, deltateam in enumerate(delta._teams):
+                team = TeamInfo()
+                if self._teams is not None and i < len(self._teams):
+                    team.name = self._teams[i].name
+                    team.color = self._teams[i].color
+                    team.score = self._teams[i].score
+                if delta.flags & SQF_TEAMINFO_NAME:
+                    team.name = deltateam.name
+                if delta.flags & SQF_TEAMINFO_COLOR:
+                    team.color = deltateam.color
+                if delta.flags & SQF_TEAMINFO_SCORE:
+                    team.score = deltateam.score
+                teams.append(team)
+            merged._teams = teams
+        return merged
+
+    def gamemode_name(self):
+        if self.gamemode is None or self.gamemode >= len(GAMEMODE_STRING):
+            return None
+        return GAMEMODE_STRING[self.gamemode]
+
+    # Reads the rest of the reply, from the player data onward
+    def _parse_remaining(self):
+        if self._remaining is None:
+            return
+        with self._parse_lock:
+            bb = self._remaining
+            if bb is None:
+                return
+            try:
+                self.__parse(bb)
+            finally:
+                # Done (or corrupt, which it'll be just as much next time)
+                self._remaining = None
+
+    def __parse(self, bb):
+        bitflags = self.flags
+        if bitflags & SQF_PLAYERDATA:
+            # The server SHOULD send us SQF_NUMPLAYERS previously or else Zan is bugged
+            players = []
+            for p in range(self.numplayers or 0):
+                name, score, ping, is_spectator, is_bot, team, time_minutes = bb.get_record(PLAYER_SCHEMA)
+                players.append(PlayerInfo(name, score, ping, is_spectator > 0, is_bot > 0, team, time_minutes))
+            self._players = players
+        if bitflags & SQF_TEAMINFO_NUMBER:
+            self._numteams = bb.get_byte()
+        if bitflags & (SQF_TEAMINFO_NAME | SQF_TEAMINFO_COLOR | SQF_TEAMINFO_SCORE):
+            teams = []
+            for i in range(self._numteams or 0):
+                team = TeamInfo()
+                if bitflags & SQF_TEAMINFO_NAME:
+                    team.name = bb.get_string_null_terminated()
+                if bitflags & SQF_TEAMINFO_COLOR:
+                    team.color = bb.get_int()
+                if bitflags & SQF_TEAMINFO_SCORE:
+                    team.score = bb.get_short()
+                teams.append(team)
+            self._teams = teams
+        if bitflags & SQF_TESTING_SERVER:
+            self._is_testing_server = bb.get_byte() > 0
+            self._testing_binary = bb.get_string_null_terminated()
+        if bitflags & SQF_DATA_MD5SUM:
+            self._data_md5sum = bb.get_string_null_terminated()
+        if bitflags & SQF_ALL_DMFLAGS:
+            num_dm_flags = bb.get_byte()
+            dmflaglist = [0, 0, 0, 0, 0]  # DMFlags, DMFlags2, DMFlags3/ZaDMFlags, CompatFlags, CompatFlags2/ZaComp
+            for flagindex in range(num_dm_flags):
+                value = bb.get_int()
+                if flagindex < len(dmflaglist):
+                    dmflaglist[flagindex] = value
+            self._dmflags = dmflaglist
+        if bitflags & SQF_SECURITY_SETTINGS:
+            self._is_security_set = bb.get_byte() > 0
+
+    # A list of PlayerInfo
+    @property
+    def players(self):
+        self._parse_remaining()
+        return self._players
+
+    @property
+    def numteams(self):
+        self._parse_remaining()
+        return self._numteams
+
+    # A list of TeamInfo
+    @property
+    def teams(self):
+        self._parse_remaining()
+        return self._teams
+
+    @property
+    def is_testing_server(self):
+        self._parse_remaining()
+        return self._is_testing_server
+
+    @property
+    def testing_binary(self):
+        self._parse_remaining()
+        return self._testing_binary
+
+    @property
+    def data_md5sum(self):
+        self._parse_remaining()
+        return self._data_md5sum
+
+    # DMFlags, DMFlags2, DMFlags3/ZaDMFlags, CompatFlags, CompatFlags2/ZaComp
+    @property
+    def dmflags(self):
+        self._parse_remaining()
+        return self._dmflags
+
+    @property
+    def is_security_set(self):
+        self._parse_remaining()
+        return self._is_security_set
+
+
+# Keeps the last full reply of every server, so that between full refreshes
+# only the volatile fields need to be asked for and parsed
+# - Use flags_for() to find out what to ask a server for, and pass what came
+# back to merge(). If merge() returns None for a delta reply, the map changed
+# (or the reply was corrupt) and the server has to be asked for the full set
+# of flags again
+# - A server gets a full refresh once every full_refresh_interval seconds and
+# after invalidate() is called for it
+class DeltaTracker:
+    def __init__(self, full_refresh_interval):
+        self._full_refresh_interval = full_refresh_interval
+        self._lock = threading.Lock()
+        self._snapshots = {}
+
+    def flags_for(self, key):
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+        if snapshot is None or snapshot[0] + self._full_refresh_interval <= time.monotonic():
+            return SQF_FULL_FLAGS
+        return SQF_VOLATILE_FLAGS
+
+    # Returns the full result for a reply to the flags from flags_for(), or
+    # None if the reply was corrupt
+    def merge(self, key, flags, result):
+        if result is None:
+            return None
+        if flags == SQF_FULL_FLAGS:
+            # Every merge reads the whole snapshot, so it had better not be corrupt
+            try:
+                result._parse_remaining()
+            except ByteBufferException as e:
+                print("ByteBuffer extraction failed:", e)
+                return None
+            with self._lock:
+                self._snapshots[key] = (time.monotonic(), result)
+            return result
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is None or result.mapname != snapshot[1].mapname:
+                self._snapshots.pop(key, None)
+                return None
         try:
-            # Set socket options
-            s.setblocking(True)
-            s.settimeout(5.0)
-
-            # Send out the encoded data, and wait for the response
-            s.sendto(encodeddata, (ip, port))
-            data, address = s.recvfrom(2048)  # This should be big enough to hold the information...
-            decodeddata = net.huffman.decode(data)
-            bb = ByteBuffer(True)
-            bb.put_bytes(decodeddata)
-            print("Decoded data length =", len(decodeddata))
-            print(decodeddata)
-
-            # Go through the elements now, starting with the header
-            firstheader = bb.get_int()
-            if firstheader != 5660023:  # If it's not this number, we're flooding or banned
-                return False
-
-            # Discard the time, we don't care
-            bb.get_int()
-
-            # Get the custom version string
-            versionstring = bb.get_string_null_terminated()
-            print("Version:", versionstring)
-
-            # Check what fields we're sent back
-            bitflags = bb.get_int()
-            print("Bit flags:", bitflags)
-            if bitflags & SQF_NAME:
-                servername = bb.get_string_null_terminated()
-                print("Server name:", servername)
-            if bitflags & SQF_URL:
-                url = bb.get_string_null_terminated()
-                print("URL:", url)
-            if bitflags & SQF_EMAIL:
-                email = bb.get_string_null_terminated()
-                print("Email:", email)
-            if bitflags & SQF_MAPNAME:
-                mapname = bb.get_string_null_terminated()
-                print("Map name:", mapname)
-            if bitflags & SQF_MAXCLIENTS:
-                maxclients = bb.get_byte()
-                print("Max clients:", maxclients)
-            if bitflags & SQF_MAXPLAYERS:
-                maxplayers = bb.get_byte()
-                print("Max players:", maxplayers)
-            if bitflags & SQF_PWADS:
-                numpwads = bb.get_byte()
-                pwadlist = []
-                for i in range(numpwads):
-                    pwadlist.append(bb.get_string_null_terminated())
-                print("Pwads:", pwadlist)
-            if bitflags & SQF_GAMETYPE:
-                gamemode = bb.get_byte()
-                is_instagib = bb.get_byte() > 0
-                is_buckshot = bb.get_byte() > 0
-                print("Gamemode is", GAMEMODE_STRING[gamemode], ", Instagib:", is_instagib, ", Buckshot:", is_buckshot)
-            if bitflags & SQF_GAMENAME:
-                gamename = bb.get_string_null_terminated()
-                print("Game name:", gamename)
-            if bitflags & SQF_IWAD:
-                iwad = bb.get_string_null_terminated()
-                print("Iwad:", iwad)
-            if bitflags & SQF_FORCEPASSWORD:
-                is_force_password = bb.get_byte() > 0
-                print("Force pass:", is_force_password)
-            if bitflags & SQF_FORCEJOINPASSWORD:
-                is_force_join_password = bb.get_byte() > 0
-                print("Force join pass:", is_force_join_password)
-            if bitflags & SQF_GAMESKILL:
-                gameskill = bb.get_byte()
-                print("Game skill level:", gameskill)
-            if bitflags & SQF_BOTSKILL:
-                botskill = bb.get_byte()
-                print("Bot skill level:", botskill)
-            if bitflags & SQF_DMFLAGS:
-                old_dmflags = bb.get_int()
-                old_dmflags2 = bb.get_int()
-                old_compatflags = bb.get_int()
-                print("WARNING: Got deprecated flag SQF_DMFLAGS")
-            if bitflags & SQF_LIMITS:
-                fraglimit = bb.get_short_unsigned()
-                timelimit = bb.get_short_unsigned()
-                if timelimit > 0:
-                    time_left_mins = bb.get_short_unsigned()  # Apparently this is only sent if the time limit > 0
-                    print("TimeLeftMinutes =", time_left_mins)
-                duellimit = bb.get_short_unsigned()
-                pointlimit = bb.get_short_unsigned()
-                winlimit = bb.get_short_unsigned()
-                print("Limits: Frags =", fraglimit, ", Timelimit =", timelimit, ", Duellimit =", duellimit,
-                      ", Pointlimit =", pointlimit, ", Winlimit =", winlimit)
-            if bitflags & SQF_TEAMDAMAGE:
-                teamdamagefactor = bb.get_float()
-                print("Team damage factor:", teamdamagefactor)
-            if bitflags & SQF_TEAMSCORES:
-                teamscore_red = bb.get_short()
-                teamscore_blue = bb.get_short()
-                print("WARNING: Got deprecated flag SQF_TEAMSCORES, this may not even be parsed right")
-            if bitflags & SQF_NUMPLAYERS:
-                numplayers = bb.get_byte()
-                print("Number of players:", numplayers)
-            if bitflags & SQF_PLAYERDATA:
-                print("Player data for ", numplayers, " players:")
-                for p in range(numplayers):  # The server SHOULD send us SQF_NUMPLAYERS previously or else Zan is bugged
-                    player_name = bb.get_string_null_terminated()
-                    player_scorecount = bb.get_short()
-                    player_ping = bb.get_short()
-                    player_is_spec = bb.get_byte() > 0
-                    player_is_bot = bb.get_byte() > 0
-                    player_team = bb.get_byte()
-                    player_time_minutes = bb.get_byte()
-                    print("\tPlayer", player_name, ": points =", player_scorecount, ", ping =", player_ping,
-                          ", is spec =", player_is_spec, ", is bot = ", player_is_bot, ", team =", player_team,
-                          ", time in server (minutes) =", player_time_minutes)
-            if bitflags & SQF_TEAMINFO_NUMBER:
-                numteams = bb.get_byte()
-                print("Number of teams:", numteams)
-            if bitflags & SQF_TEAMINFO_NAME or bitflags & SQF_TEAMINFO_COLOR or bitflags & SQF_TEAMINFO_SCORE:
-                for i in range(numteams):
-                    if bitflags & SQF_TEAMINFO_NAME:
-                        team_name = bb.get_string_null_terminated()
-                        print(i, " team's name:", team_name)
-                    if bitflags & SQF_TEAMINFO_COLOR:
-                        team_color = bb.get_int()
-                        print(i, " team's color:", team_color)
-                    if bitflags & SQF_TEAMINFO_SCORE:
-                        team_score = bb.get_short()
-                        print(i, " team's score:", team_score)
-            if bitflags & SQF_TESTING_SERVER:
-                is_running_custom = bb.get_byte() > 0
-                custom_binary_name = bb.get_string_null_terminated()
-                print("Running custom =", is_running_custom, "[", custom_binary_name, "]")
-            if bitflags & SQF_DATA_MD5SUM:
-                data_md5_sum = bb.get_string_null_terminated()
-                print("MD5 sum:", data_md5_sum)
-            if bitflags & SQF_ALL_DMFLAGS:
-                num_dm_flags = bb.get_byte()
-                dmflaglist = [0, 0, 0, 0, 0]  # DMFlags, DMFlags2, DMFlags3/ZaDMFlags, CompatFlags, CompatFlags2/ZaComp
-                for flagindex in range(num_dm_flags):
-                    dmflaglist[flagindex] = bb.get_int()
-                print("DMFlag/CompatFlag list:", dmflaglist)
-            if bitflags & SQF_SECURITY_SETTINGS:
-                is_security_set = bb.get_byte() > 0
-                print("Security set:", is_security_set)
-            print("Done reading, left over bytes =", bb.size())
-        except socket.timeout:
-            print("Timeout when trying to perform a server query to", ip, port)
-            return False
+            return snapshot[1].merge(result)
         except ByteBufferException as e:
             print("ByteBuffer extraction failed:", e)
-            return False
-    return True
+            return None
+
+    # Makes the next query of the server a full refresh
+    def invalidate(self, key):
+        with self._lock:
+            self._snapshots.pop(key, None)
+
+
+# Performs a server query through a DeltaTracker, returns the full
+# ServerQueryResult or None if it failed
+# - A server that doesn't answer (or refuses us) isn't asked again straight
+# away, it gets a full query next time instead. Only a delta reply that came
+# back with another map, or corrupt, is followed by a full query
+def perform_delta_server_query(tracker, ip, port):
+    key = (ip, port)
+    flags = tracker.flags_for(key)
+    reply = perform_server_query(ip, port, flags)
+    if reply is None:
+        tracker.invalidate(key)
+        return None
+    result = tracker.merge(key, flags, reply)
+    if result is None and flags != SQF_FULL_FLAGS:
+        result = tracker.merge(key, SQF_FULL_FLAGS, perform_server_query(ip, port, SQF_FULL_FLAGS))
+    return result
@@ -0,0 +1,90 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+# What the signing key is derived from the network secret with, so the key
+# isn't the secret itself
+KEY_DERIVATION_LABEL = b'doomhost session token'
+
+# The default for how long a token is good for (seconds)
+DEFAULT_SESSION_TTL = 900
+
+
+# Hands out signed tokens to users that logged in with their password, so
+# their next requests only need an HMAC check instead of a bcrypt one
+# - A token is <session id>.<expiry>.<signature>, where the signature is an
+# HMAC of the id, expiry and username keyed from the network secret
+# - Sessions are also kept in memory, so a token only works on the listener
+# that gave it out and stops working when we restart or it's revoked
+class SessionTokens:
+    def __init__(self, secret, ttl=DEFAULT_SESSION_TTL):
+        self._key = hmac.new(secret.encode('utf-8'), KEY_DERIVATION_LABEL, hashlib.sha256).digest()
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = {}  # Session id -> (username, user, expiry)
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    # Starts a session for the user, returns its token
+    def create(self, username, user):
+        session_id = os.urandom(16).hex()
+        expiry = int(time.time()) + self._ttl
+        with self._lock:
+            self._prune()
+            self._sessions[session_id] = (username, user, expiry)
+        return '{}.{}.{}'.format(session_id, expiry, self._sign(session_id, expiry, username))
+
+    # Returns the user of the session if the token is good for the username,
+    # None otherwise
+    def check(self, username, token):
+        try:
+            session_id, expiry, signature = str(token).split('.')
+            expiry = int(expiry)
+        except ValueError:
+            return None
+        if expiry <= time.time():
+            return None
+        # Compared as bytes, compare_digest won't take a str that isn't ASCII
+        if not hmac.compare_digest(signature.encode('utf-8', 'surrogatepass'),
+                                   self._sign(session_id, expiry, username).encode('ascii')):
+            return None
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None or session[0] != username or session[2] != expiry:
+            return None
+        return session[1]
+
+    # Ends the session of the token, if it has one
+    def revoke(self, token):
+        session_id = str(token).split('.', 1)[0]
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _sign(self, session_id, expiry, username):
+        message = '{}.{}.{}'.format(session_id, expiry, username).encode('utf-8', 'surrogatepass')
+        return hmac.new(self._key, message, hashlib.sha256).hexdigest()
+
+    # Must hold the lock
+    def _prune(self):
+        now = time.time()
+        for session_id in [session_id for session_id, session in self._sessions.items() if session[2] <= now]:
+            del self._sessions[session_id]
@@ -13,16 +13,107 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import json
 import socket
 import time
 import struct
 import os
+import threading
+import uuid
+import concurrent.futures
+import contextlib
 from doom import doomserver
+from doom import wadstore
+from net import rcon
+from net import sessiontokens
+from database import passwordhasher
 from output.printlogger import *
 
+# The defaults for how many clients are handled at once, and how many of
+# them can be uploading at once
+DEFAULT_MAX_CONNECTIONS = 32
+DEFAULT_MAX_UPLOADS = 4
+
+# How long an upload waits for a free upload slot before giving up (seconds)
+UPLOAD_WAIT_TIMEOUT = 30.0
+
+# The default size of the chunks framed uploads are received in
+DEFAULT_UPLOAD_CHUNK_SIZE = 1 << 20
+
+# The default for the biggest file that can be uploaded (bytes)
+DEFAULT_MAX_UPLOAD_SIZE = 256 << 20
+
+# How long we wait on a client that stopped sending (seconds)
+CLIENT_TIMEOUT = 60.0
+
+
+# A connected client, everything that's sent back to it goes through here so
+# replies from different threads can't get mixed up
+class TCPClient():
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+        self._lock = threading.Lock()
+
+    # Sends a reply to the client
+    def reply(self, status, message):
+        self.send({'status': status, 'message': message})
+
+    # Sends a JSON object to the client
+    def send(self, reply):
+        with self._lock:
+            try:
+                self.connection.sendall(bytes(json.dumps(reply), encoding='utf-8'))
+            except OSError as e:
+                log(LEVEL_WARNING, "Could not reply to {}: {}".format(self.address[0], e))
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+# Where the replies to one request go, every reply carries the request's ID
+# so the client can tell what it's an answer to
+# - The reply marked final closes the connection, anything after it is dropped.
+# A request that finishes later, like a server starting up, keeps its channel
+# and replies on it whenever it's done
+class ReplyChannel():
+    def __init__(self, client, request_id):
+        self.client = client
+        self.request_id = request_id
+        self.is_closed = False
+        self._lock = threading.Lock()
+
+    # Any extra keyword arguments are sent as fields of the reply
+    def reply(self, status, message, final=False, **fields):
+        with self._lock:
+            if self.is_closed:
+                log(LEVEL_WARNING, "Dropping reply \"{}\" to request {}, it was already answered.".format(message, self.request_id))
+                return
+            reply = dict(fields)
+            reply['status'] = status
+            reply['message'] = message
+            if self.request_id is not None:
+                reply['request_id'] = self.request_id
+            self.client.send(reply)
+            if final:
+                self.is_closed = True
+                self.client.close()
+
+    # Closes the connection without replying again
+    def close(self):
+        with self._lock:
+            if not self.is_closed:
+                self.is_closed = True
+                self.client.close()
+
 
 # Listens for incoming messages and performs appropriate actions
+# - Every client is handled on a worker thread. At most max_connections are
+# handled at once, after that we stop accepting and they wait in the backlog
+# - At most max_uploads clients can be uploading at once, the others wait for
+# a slot and are turned away if one doesn't free up in time
 class TCPListener():
 
     # Our reply status
@@ -33,170 +124,432 @@ class TCPListener():
     # The listener will error out if these are not present
     # NOTE: This does not validate the values, but only shows if they are present
     required_fields = {
-        'general': ['username', 'password'],
+        'general': ['username'],
+        'login':   ['password'],
         'host':    ['hostname', 'iwad', 'gamemode'],
         'kill':    ['port'],
-        'upload':  ['name', 'type']
+        'upload':  ['name', 'type'],
+        'status':  [],
+        'rcon':    ['port', 'command'],
+        'broadcast': ['command']
     }
 
-    def __init__(self, doomhost, hostname, port, secret):
+    def __init__(self, doomhost, hostname, port, secret, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 max_uploads=DEFAULT_MAX_UPLOADS, upload_chunk_size=DEFAULT_UPLOAD_CHUNK_SIZE,
+                 session_ttl=sessiontokens.DEFAULT_SESSION_TTL, max_upload_size=DEFAULT_MAX_UPLOAD_SIZE):
         self.doomhost = doomhost
         self._hostname = hostname
         self._port = port
         self._secret = secret
         self._blacklist = []
-        # Since our listener isn't threaded, this should be more convenient
-        self.connection = None
+        self._blacklist_lock = threading.Lock()
+        self._max_connections = max_connections
+        self._connection_slots = threading.BoundedSemaphore(max_connections)
+        self._upload_slots = threading.BoundedSemaphore(max_uploads)
+        self._upload_chunk_size = upload_chunk_size
+        self._max_upload_size = max_upload_size
+        self.sessions = sessiontokens.SessionTokens(secret, session_ttl)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     # Checks to make sure an action has all the data that it needs
-    def check_required_fields(self, action, array_data):
+    def check_required_fields(self, channel, action, array_data):
         for field in self.required_fields[action]:
             if field not in array_data:
                 log(LEVEL_WARNING, "Missing {} from JSON data.".format(field))
-                self.reply(self.STATUS_ERROR, "Looks like not all information was filled out. Please fill out {}".format(field))
+                channel.reply(self.STATUS_ERROR, "Looks like not all information was filled out. Please fill out {}".format(field))
                 return False
         return True
 
-    # Sends a reply to the client
-    def reply(self, status, message):
-        reply = {'status': status, 'message': message}
-        self.connection.send(bytes(json.dumps(reply), encoding='utf-8'))
-
     # Check if an IP address is banned
     def is_banned(self, address):
-        for i, (hostname, unbantime) in enumerate(self._blacklist):
-            if hostname == address:
-                if unbantime < int(time.time()):
-                    del self._blacklist[i]
-                    log(LEVEL_STATUS, "Ban on {} expired.".format(hostname))
-                    return False
-                else:
-                    return True
+        with self._blacklist_lock:
+            for i, (hostname, unbantime) in enumerate(self._blacklist):
+                if hostname == address:
+                    if unbantime < int(time.time()):
+                        del self._blacklist[i]
+                        log(LEVEL_STATUS, "Ban on {} expired.".format(hostname))
+                        return False
+                    else:
+                        return True
         return False
 
+    # Bans an IP address for some seconds, if it isn't already
+    def ban(self, address, seconds):
+        with self._blacklist_lock:
+            for hostname, bantime in self._blacklist:
+                if hostname == address:
+                    return
+            self._blacklist.append((address, int(time.time()) + seconds))
+
     # Scans the packet received for our JSON string and returns a tuple containing the JSON string and the rest of the packet
     def extract_string(self, bytes):
         length = struct.unpack('h', bytes[:2])[0]
         return (bytes[2:length+2].decode('utf-8'), bytes[length+2:])
 
-    def process_upload_packet(self, data, address, rest):
+    # Receives an upload, either framed or legacy
+    # - A framed upload declares its length in the 'size' field, and exactly
+    # that many bytes follow the header, zero bytes and all. They're streamed
+    # straight into the temporary file in chunks of upload_chunk_size
+    # - Uploads bigger than max_upload_size are turned away
+    # - A legacy upload ends with a null byte, and the last byte of every chunk
+    # is thrown away, so it's only kept for frontends that still send it
+    # - Files are kept in a WadStore. If the header has a 'sha256' we already
+    # have, the name is linked to it and nothing is sent, which the client
+    # knows from the reply not being "Downloading file". Otherwise the upload
+    # is hashed as it comes in and checked against the 'sha256'
+    def process_upload_packet(self, channel, data, address, rest):
         data['name'] == data['name'].lower()
         extension = os.path.splitext(data['name'])[1][1:]
-        if not self.check_required_fields('upload', data):
+        if not self.check_required_fields(channel, 'upload', data):
             return
         file_check_result = self.doomhost.check_valid_file(data['type'], extension)
         if file_check_result[0] == False:
             log(LEVEL_WARNING, file_check_result[1])
-            self.reply(self.STATUS_ERROR, file_check_result[1])
+            channel.reply(self.STATUS_ERROR, file_check_result[1])
             return
         location = file_check_result[1]
-        self.reply(self.STATUS_OK, "Downloading file")
-        log(LEVEL_STATUS, "Downloading {} from {}".format(data['name'], address))
-        timestamp = time.time()
-        # Create a temporary file that we write to, which we'll move to our final directory later
-        f = open(data['name'] + '_' + str(timestamp), 'bw+')
+        store = self.doomhost.get_wad_store(location)
+        digest = None
+        if 'sha256' in data:
+            digest = str(data['sha256']).lower()
+            if not wadstore.is_valid_digest(digest):
+                channel.reply(self.STATUS_ERROR, "Invalid sha256 hash.")
+                return
+            if store.has_blob(digest):
+                store.link(digest, data['name'])
+                log(LEVEL_OK, "Already have {} from {}, nothing to download".format(data['name'], address))
+                channel.reply(self.STATUS_OK, "File already exists")
+                return
+        size = None
+        if 'size' in data:
+            try:
+                size = int(data['size'])
+            except (TypeError, ValueError):
+                size = -1
+            if size < 0:
+                channel.reply(self.STATUS_ERROR, "Invalid file size.")
+                return
+            if size > self._max_upload_size:
+                log(LEVEL_WARNING, "Turning away {} from {}, {} bytes is over the upload limit".format(data['name'], address, size))
+                channel.reply(self.STATUS_ERROR, "The file is too big, the limit is {} bytes.".format(self._max_upload_size))
+                return
+        if not self._upload_slots.acquire(timeout=UPLOAD_WAIT_TIMEOUT):
+            log(LEVEL_WARNING, "Too many uploads at once, turning away {} from {}".format(data['name'], address))
+            channel.reply(self.STATUS_ERROR, "The server is busy with other uploads. Please try again later.")
+            return
+        # Create a temporary file that we write to, which we'll move into the store later. Whatever
+        # happens to the upload, the file is deleted unless it made it into the store
+        temp_name = store.make_temp_path()
+        try:
+            try:
+                channel.reply(self.STATUS_OK, "Downloading file")
+                log(LEVEL_STATUS, "Downloading {} from {}".format(data['name'], address))
+                timestamp = time.time()
+                hasher = hashlib.sha256()
+                with open(temp_name, 'bw+') as f:
+                    if size is None:
+                        received = self.receive_legacy_upload(channel.client.connection, f, rest, hasher)
+                    else:
+                        received = self.receive_framed_upload(channel.client.connection, f, size, rest, hasher)
+                elapsed = time.time() - timestamp
+            finally:
+                self._upload_slots.release()
+            if size is None and received > self._max_upload_size:
+                log(LEVEL_WARNING, "Upload of {} from {} went over the upload limit".format(data['name'], address))
+                channel.reply(self.STATUS_ERROR, "The file is too big, the limit is {} bytes.".format(self._max_upload_size))
+                return
+            if size is not None and received != size:
+                log(LEVEL_WARNING, "Upload of {} from {} was {} bytes instead of {}".format(data['name'], address, received, size))
+                channel.reply(self.STATUS_ERROR, "Received {} bytes but expected {}.".format(received, size))
+                return
+            if digest is not None and hasher.hexdigest() != digest:
+                log(LEVEL_WARNING, "Upload of {} from {} doesn't match its sha256".format(data['name'], address))
+                channel.reply(self.STATUS_ERROR, "The file doesn't match its sha256 hash.")
+                return
+            # We have our file, put it in the store and give it its name
+            digest = hasher.hexdigest()
+            store.add_blob(temp_name, digest)
+            temp_name = None
+        finally:
+            if temp_name is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(temp_name)
+        store.link(digest, data['name'])
+        log(LEVEL_OK, "Finished downloading {} and moved to {} ({} bytes in {:.2f}s, {:.2f} MB/s)".format(
+            data['name'], location + data['name'], received, elapsed, received / max(elapsed, 1e-6) / 1048576))
+        channel.reply(self.STATUS_OK, "Successfully downloaded file")
+
+    # Writes exactly size bytes of the upload to the file and the hasher,
+    # returns how many bytes were actually received (more than size if the
+    # header packet carried too many, less if the client hung up)
+    def receive_framed_upload(self, connection, f, size, rest, hasher):
+        if len(rest) > size:
+            return len(rest)
+        if hasattr(os, 'posix_fallocate') and size > 0:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except OSError:
+                pass  # Not every filesystem can do it, the writes still work
+        f.write(rest)
+        hasher.update(rest)
+        received = len(rest)
+        buffer = memoryview(bytearray(min(self._upload_chunk_size, max(size - received, 1))))
+        while received < size:
+            length = connection.recv_into(buffer, min(len(buffer), size - received))
+            if length == 0:
+                break
+            f.write(buffer[:length])
+            hasher.update(buffer[:length])
+            received += length
+        return received
+
+    # Writes a null terminated upload to the file and the hasher, returns how
+    # many bytes were written. It stops once it's over the upload limit
+    def receive_legacy_upload(self, connection, f, rest, hasher):
         # Our first packet actually contained some data for the file that we need, write it!
-        f.write(rest[:-1])
+        received = f.write(rest[:-1])
+        hasher.update(rest[:-1])
         # Since we're getting a large file, we need to keep listening for more information
-        file_data = self.connection.recv(4096)
+        file_data = connection.recv(4096)
         while (file_data):
-            f.write(file_data[:-1])
+            received += f.write(file_data[:-1])
+            hasher.update(file_data[:-1])
             # Null terminator at the end of the byte sequence indicates that there is no more data being sent
-            if file_data[-1:] == b'\x00':
+            if file_data[-1:] == b'\x00' or received > self._max_upload_size:
                 break
-            file_data = self.connection.recv(4096)
-        f.close()
-        # We have our file, move it to the appropriate directory
-        os.rename(data['name'] + '_' + str(timestamp), location + data['name'])
-        log(LEVEL_OK, "Finished downloading {} and moved to {}".format(data['name'], location + data['name']))
-        self.reply(self.STATUS_OK, "Successfully downloaded file")
-
-    def process_host_packet(self, data, address):
-        log(LEVEL_STATUS, "Processing host action from {}".format(address))
-        if not self.check_required_fields('host', data):
-            return
-        if self.doomhost.get_first_free_port() is None:
-            self.reply(self.STATUS_ERROR, "The global server limit has been reached.")
-            log(LEVEL_WARNING, "The global server limit has been reached.")
-            return
-        if doomserver.is_valid_server(data):
-            doomserver.DoomServer(data, self.doomhost)
-        else:
+            file_data = connection.recv(4096)
+        return received
+
+    # Returns whether the reply channel was handed to a server, which gives the
+    # final reply once it has started or failed to
+    def process_host_packet(self, channel, data, address):
+        log(LEVEL_STATUS, "Processing host action from {} (request {})".format(address, channel.request_id))
+        if not self.check_required_fields(channel, 'host', data):
+            return False
+        if not doomserver.is_valid_server(data):
             log(LEVEL_WARNING, "Received server host request without all information, ignoring...")
+            return False
+        # The port is ours until the server is up or fails, so a request at the same time can't take it too
+        port = self.doomhost.reserve_port()
+        if port is None:
+            channel.reply(self.STATUS_ERROR, "The global server limit has been reached.")
+            log(LEVEL_WARNING, "The global server limit has been reached.")
+            return False
+        server = doomserver.DoomServer(data, self.doomhost, channel, port)
+        return self.doomhost.get_server(port) is server
 
-    def process_kill_packet(self, data, address):
+    def process_kill_packet(self, channel, data, address):
         log(LEVEL_STATUS, "Processing kill action from {}".format(address))
-        if not self.check_required_fields('kill', data):
+        if not self.check_required_fields(channel, 'kill', data):
             return
         if not self.doomhost.is_valid_port(data['port']):
             log(LEVEL_WARNING, "Invalid port sent from {}".format(address))
-            self.reply(self.STATUS_ERROR, "Invalid port.")
+            channel.reply(self.STATUS_ERROR, "Invalid port.")
             return
         server = self.doomhost.get_server(data['port'])
         if server is not None:
             if server.status is not server.SERVER_STARTING:
                 server.process.kill_server()
-                self.reply(self.STATUS_OK, "Killed server.")
+                channel.reply(self.STATUS_OK, "Killed server.")
             else:
                 log(LEVEL_STATUS, "Not killing a server that hasn't started yet.")
-                self.reply(self.STATUS_ERROR, "Server must load up before being killed.")
+                channel.reply(self.STATUS_ERROR, "Server must load up before being killed.")
         else:
             log(LEVEL_STATUS, "Can't find server running on port {} to kill".format(data['port']))
-            self.reply(self.STATUS_ERROR, "Server running on port {} does not exist.".format(data['port']))
+            channel.reply(self.STATUS_ERROR, "Server running on port {} does not exist.".format(data['port']))
+
+    # Returns the running server on the port in the request if it's the user's,
+    # or None (after replying) if it isn't
+    def get_owned_server(self, channel, data, address):
+        try:
+            port = int(data['port'])
+        except (TypeError, ValueError):
+            port = None
+        if port is None or not self.doomhost.is_valid_port(port):
+            log(LEVEL_WARNING, "Invalid port sent from {}".format(address))
+            channel.reply(self.STATUS_ERROR, "Invalid port.")
+            return None
+        server = self.doomhost.get_server(port)
+        if server is None or server.status != server.SERVER_RUNNING or server.owner['id'] != data['user']['id']:
+            channel.reply(self.STATUS_ERROR, "You don't have a server running on port {}.".format(port))
+            return None
+        return server
+
+    # Replies with the map and players of the user's server on the port, or of
+    # all of their running servers if there's no port
+    # - What RCON pushed to us is used when we have it, so most of these don't
+    # send a launcher query. The others come from the query cache, or from one
+    # sweep if there's more than one of them
+    def process_status_packet(self, channel, data, address):
+        log(LEVEL_STATUS, "Processing status action from {}".format(address))
+        if 'port' in data:
+            server = self.get_owned_server(channel, data, address)
+            if server is None:
+                return
+            servers = [server]
+        else:
+            servers = [server for server in list(self.doomhost.servers) if server.status == server.SERVER_RUNNING and
+                       server.owner['id'] == data['user']['id']]
+        statuses = []
+        unwatched = []
+        for server in servers:
+            state = self.doomhost.get_live_state(server.port)
+            if state is not None and state.last_update is not None:
+                statuses.append({'port': server.port, 'mapname': state.mapname, 'players': list(state.players)})
+            else:
+                unwatched.append(server)
+        if len(unwatched) > 1:
+            results = self.doomhost.query_servers()
+        else:
+            results = {server.port: self.doomhost.query_server(server.port) for server in unwatched}
+        for server in unwatched:
+            result = results.get(server.port)
+            if result is None:
+                statuses.append({'port': server.port, 'mapname': None, 'players': None})
+            else:
+                statuses.append({'port': server.port, 'mapname': result.mapname,
+                                 'players': [player.name for player in result.players or []]})
+        channel.reply(self.STATUS_OK, "Server status.", servers=statuses)
+
+    # Checks that the command in the request can be sent over RCON, which only takes ASCII
+    def check_rcon_command(self, channel, data):
+        if not isinstance(data['command'], str) or not data['command'].strip() or not data['command'].isascii():
+            channel.reply(self.STATUS_ERROR, "Invalid command.")
+            return False
+        return True
+
+    # Runs an RCON command on the user's server on the port
+    def process_rcon_packet(self, channel, data, address):
+        log(LEVEL_STATUS, "Processing rcon action from {}".format(address))
+        if not self.check_required_fields(channel, 'rcon', data) or not self.check_rcon_command(channel, data):
+            return
+        server = self.get_owned_server(channel, data, address)
+        if server is None:
+            return
+        if self.doomhost.send_rcon(server.port, data['command']):
+            channel.reply(self.STATUS_OK, "Command sent.")
+        else:
+            channel.reply(self.STATUS_ERROR, "Could not send the command to the server.")
+
+    # Runs an RCON command on all of the user's running servers at once, the
+    # reply has what happened on each port
+    def process_broadcast_packet(self, channel, data, address):
+        log(LEVEL_STATUS, "Processing broadcast action from {}".format(address))
+        if not self.check_required_fields(channel, 'broadcast', data) or not self.check_rcon_command(channel, data):
+            return
+        results = self.doomhost.broadcast_rcon(data['command'], data['user']['id'])
+        channel.reply(self.STATUS_OK, "Command sent to {} of {} servers.".format(
+            sum(1 for result in results.values() if result == rcon.BROADCAST_SENT), len(results)),
+            results={str(port): result for port, result in results.items()})
+
+    # Returns the user the request is from, checking its session token if it
+    # has one and its password otherwise, or None (after replying) if neither is good
+    # - Only a login or an expired token needs the password, so the bcrypt
+    # check doesn't run on every request
+    def authenticate(self, channel, data, address):
+        if 'token' in data and data.get('action') != 'login':
+            user = self.sessions.check(data['username'], data['token'])
+            if user is None:
+                log(LEVEL_STATUS, "Expired or invalid session token for {} from {}".format(data['username'], address))
+                channel.reply(self.STATUS_ERROR, "Your session has expired, please log in again.", session_expired=True)
+            return user
+        if not self.check_required_fields(channel, 'login', data):
+            return None
+        try:
+            is_valid_login = self.doomhost.db.check_login(data['username'], data['password']).result()
+        except passwordhasher.PasswordQueueFullException as e:
+            log(LEVEL_WARNING, "Turning away login for {} from {}: {}".format(data['username'], address, e))
+            channel.reply(self.STATUS_ERROR, "The server is busy, please try again in a moment.")
+            return None
+        if not is_valid_login:
+            log(LEVEL_WARNING, "Invalid password for {} from {}".format(data['username'], address))
+            channel.reply(self.STATUS_ERROR, "Invalid username or password combination.")
+            return None
+        return self.doomhost.db.get_user(data['username'])
+
+    # Handles everything a client sent, runs on a worker thread
+    def handle_client(self, client):
+        handed_off = False
+        try:
+            handed_off = self.process_client(client)
+        except Exception as e:
+            log(LEVEL_ERROR, "Error handling request from {}: {}".format(client.address[0], e))
+        finally:
+            if not handed_off:
+                client.close()
+            self._connection_slots.release()
+
+    # Returns whether the request's reply channel was handed to something that
+    # replies on it later
+    def process_client(self, client):
+        address = client.address
+        if self.is_banned(address[0]):
+            log(LEVEL_STATUS, "Banned IP {} connecting, ignoring request.".format(address[0]))
+            client.reply(self.STATUS_ERROR, "Your IP address is banned.")
+            return False
+        client.connection.settimeout(CLIENT_TIMEOUT)
+        packet = client.connection.recv(4096)
+        try:
+            data_raw = self.extract_string(packet)[0]
+            data = json.loads(data_raw)
+            rest = self.extract_string(packet)[1]
+        except (ValueError, struct.error) as e:
+            log(LEVEL_WARNING, "Received incorrectly formatted JSON string {} from {}".format(packet[:64], address[0]))
+            client.reply(self.STATUS_ERROR, "Looks like there was an error processing your request. Please try again.")
+            return False
+        if not data or not isinstance(data, dict):
+            return False
+        # The client can name the request itself, otherwise it gets one from us
+        channel = ReplyChannel(client, str(data.get('request_id') or uuid.uuid4().hex))
+        if 'secret' in data:
+            if data['secret']:
+                if not self.check_required_fields(channel, 'general', data):
+                    return False
+                data['user'] = self.authenticate(channel, data, address[0])
+                if data['user'] is None:
+                    return False
+                # Process the packet
+                if data['action'] == 'login':
+                    token = self.sessions.create(data['username'], data['user'])
+                    channel.reply(self.STATUS_OK, "Logged in.", token=token, expires_in=self.sessions.ttl)
+                elif data['action'] == 'logout':
+                    self.sessions.revoke(data.get('token', ''))
+                    channel.reply(self.STATUS_OK, "Logged out.")
+                if data['action'] == 'upload':
+                    self.process_upload_packet(channel, data, address[0], rest)
+                if data['action'] == 'host':
+                    return self.process_host_packet(channel, data, address[0])
+                elif data['action'] == 'kill':
+                    self.process_kill_packet(channel, data, address[0])
+                elif data['action'] == 'status':
+                    self.process_status_packet(channel, data, address[0])
+                elif data['action'] == 'rcon':
+                    self.process_rcon_packet(channel, data, address[0])
+                elif data['action'] == 'broadcast':
+                    self.process_broadcast_packet(channel, data, address[0])
+            else:
+                log(LEVEL_WARNING, "Incorrect secret from {}, banning address for 3 seconds.".format(address[0]))
+                channel.reply(self.STATUS_ERROR, "Received incorrect secret.")
+                # If not already in our blacklist, ban the IP for 3 seconds
+                self.ban(address[0], 3)
+        else:
+            log(LEVEL_WARNING, "Didn't receive secret from {}".format(address[0]))
+            channel.reply(self.STATUS_ERROR, "Please send us the secret!")
+        return False
 
     # Main listener function
     def serve(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((self._hostname, self._port))
-        self.socket.listen(True)
+        self.socket.listen(self._max_connections)
         log(LEVEL_OK, "Listening on {}:{}".format(self._hostname, self._port))
-        while True:
-            self.connection, address = self.socket.accept()
-            if self.is_banned(address[0]):
-                log(LEVEL_STATUS, "Banned IP {} connecting, ignoring request.".format(address[0]))
-                self.reply(self.STATUS_ERROR, "Your IP address is banned.")
-                continue
-            packet = self.connection.recv(4096)
-            try:
-                data_raw = self.extract_string(packet)[0]
-                data = json.loads(data_raw)
-                rest = self.extract_string(packet)[1]
-            except ValueError as e:
-                log(LEVEL_WARNING, "Received incorrectly formatted JSON string {} from {}".format(self.extract_string(packet)[0], address[0]))
-                self.reply(self.STATUS_ERROR, "Looks like there was an error processing your request. Please try again.")
-                self.connection.close()
-                continue
-            if not data:
-                break
-            if 'secret' in data:
-                if data['secret']:
-                    if not self.check_required_fields('general', data):
-                        continue
-                    if not self.doomhost.db.check_login(data['username'], data['password']):
-                        log(LEVEL_WARNING, "Invalid password for {} from {}".format(data['username'], address[0]))
-                        self.reply(self.STATUS_ERROR, "Invalid username or password combination.")
-                        continue
-                    data['user'] = self.doomhost.db.get_user(data['username'])
-                    # Process the packet
-                    if data['action'] == 'upload':
-                        self.process_upload_packet(data, address[0], rest)
-                    if data['action'] == 'host':
-                        self.process_host_packet(data, address[0])
-                    elif data['action'] == 'kill':
-                        self.process_kill_packet(data, address[0])
-                else:
-                    log(LEVEL_WARNING, "Incorrect secret from {}, banning address for 3 seconds.".format(address[0]))
-                    self.reply(self.STATUS_ERROR, "Received incorrect secret.")
-                    # If not already in our blacklist, ban the IP for 3 seconds
-                    banned = False
-                    for hostname, bantime in self._blacklist:
-                        if hostname == address[0]:
-                            banned = True
-                    if not banned:
-                        self._blacklist.append((address[0], int(time.time()) + 3))
-            else:
-                log(LEVEL_WARNING, "Didn't receive secret from {}".format(address[0]))
-                self.reply(self.STATUS_ERROR, "Please send us the secret!")
-        connection.close()
-
+        with concurrent.futures.ThreadPoolExecutor(self._max_connections) as executor:
+            while True:
+                # Don't take another client until one of the workers is free
+                self._connection_slots.acquire()
+                try:
+                    connection, address = self.socket.accept()
+                except OSError:
+                    self._connection_slots.release()
+                    break  # The socket was closed, we're shutting down
+                executor.submit(self.handle_client, TCPClient(connection, address))
@@ -0,0 +1,296 @@
+# Copyright (C) 2014 BestEver
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import heapq
+import selectors
+import socket
+import threading
+import time
+import net.huffman
+
+# What a datagram is, replies are routed to whoever is waiting on the same
+# address and kind
+KIND_QUERY = 0
+KIND_RCON = 1
+
+# RCON replies from the server start with one of these (SVRC_OLDPROTOCOL to
+# SVRC_UPDATE), anything else is taken as a launcher query reply
+RCON_HEADER_MIN = 32
+RCON_HEADER_MAX = 38
+
+# How many sockets the shared transport sends from
+DEFAULT_SOCKET_COUNT = 4
+
+# The size of the buffer datagrams are received into, replies should be < 576
+RECEIVE_BUFFER_SIZE = 2048
+
+# The size each socket's buffer for encoding outgoing datagrams starts at, it
+# grows if something bigger is sent
+SEND_BUFFER_SIZE = 2048
+
+# How big the kernel receive buffer of each socket is asked to be, a fleet
+# sweep can have a lot of replies arrive at once
+SOCKET_RECEIVE_BUFFER_SIZE = 1 << 20
+
+
+# Someone waiting on a reply, which has to start with one of the headers in
+# replies (any reply will do if it's None)
+class _Waiter:
+    __slots__ = ('key', 'replies', 'event', 'data', 'done')
+
+    def __init__(self, key, replies):
+        self.key = key
+        self.replies = replies
+        self.event = threading.Event()
+        self.data = None
+        self.done = False
+
+
+# Sends and receives every Zandronum datagram through a few sockets, with one
+# thread waiting on all of them
+# - Replies are routed by the (ip, port) they came from, whether they are a
+# query or an RCON reply and, for requests that said which replies they
+# expect, the reply's header. So addresses have to be numeric, and an RCON
+# update the server pushes can't be taken for a login reply. Datagrams to an
+# address always go out of the same socket, which RCON needs since the server
+# knows us by the address we log in from
+# - Every timeout lives in one heap that the thread wakes up for
+# - Outgoing datagrams are encoded into a buffer that belongs to the socket
+# they're sent from, so sending doesn't allocate
+# - Datagrams nobody is waiting for go to whoever subscribed to the address
+# and kind, or are dropped if nobody did
+class UDPTransport:
+    def __init__(self, socketcount=DEFAULT_SOCKET_COUNT):
+        self._lock = threading.Lock()
+        self._waiting = collections.defaultdict(collections.deque)  # (address, kind) -> waiters in order
+        self._timers = []  # Heap of (deadline, sequence, waiter)
+        self._sequence = 0
+        self._subscribers = {}  # (address, kind) -> callback
+        self._exclusive_locks = collections.defaultdict(threading.Lock)
+        self._selector = selectors.DefaultSelector()
+        self._sockets = []
+        self._send_locks = []
+        self._send_buffers = []
+        for i in range(socketcount):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setblocking(False)
+            try:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RECEIVE_BUFFER_SIZE)
+            except OSError:
+                pass
+            s.bind(('', 0))
+            self._selector.register(s, selectors.EVENT_READ, s)
+            self._sockets.append(s)
+            self._send_locks.append(threading.Lock())
+            self._send_buffers.append(memoryview(bytearray(SEND_BUFFER_SIZE)))
+        self._wakeup_read, self._wakeup_write = socket.socketpair()
+        self._wakeup_read.setblocking(False)
+        self._wakeup_write.setblocking(False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Stops the thread and closes every socket, anyone waiting gets None
+    def close(self):
+        self._running = False
+        self._wake()
+        self._thread.join()
+        with self._lock:
+            waiters = [waiter for deadline, sequence, waiter in self._timers]
+            self._timers = []
+            self._waiting.clear()
+        for waiter in waiters:
+            self._finish(waiter, None)
+        for s in self._sockets:
+            s.close()
+        self._selector.close()
+        self._wakeup_read.close()
+        self._wakeup_write.close()
+
+    # Returns a lock that's only for this address, hold it to keep a multi
+    # datagram exchange like an RCON login from mixing with another one
+    def exclusive(self, address):
+        with self._lock:
+            return self._exclusive_locks[address]
+
+    # Has the callback called with the decoded data of every datagram of the
+    # kind from the address that nobody is waiting for
+    # - It's called from the transport's thread, so it has to be quick
+    def subscribe(self, address, kind, callback):
+        with self._lock:
+            self._subscribers[(address, kind)] = callback
+
+    def unsubscribe(self, address, kind):
+        with self._lock:
+            self._subscribers.pop((address, kind), None)
+
+    # Encodes and sends the data
+    def send(self, address, rawdata):
+        index = self._socket_index(address)
+        with self._send_locks[index]:
+            buffer = self._send_buffers[index]
+            if len(buffer) < len(rawdata) + 1:
+                buffer = self._send_buffers[index] = memoryview(bytearray(len(rawdata) + 1))
+            length = net.huffman.encode_into(rawdata, buffer)
+            self._sockets[index].sendto(buffer[:length], address)
+
+    # Sends the data and waits for a reply of the kind, returns the decoded
+    # reply or None if it timed out
+    # - If replies is given, only a reply whose first byte is in it counts,
+    # anything else goes on to whoever else is waiting or the subscriber
+    def request(self, address, kind, rawdata, timeout, replies=None):
+        waiter = self._expect(address, kind, timeout, replies)
+        try:
+            self.send(address, rawdata)
+        except OSError:
+            self._cancel(waiter)
+            return None
+        waiter.event.wait()
+        return waiter.data
+
+    # Registers a waiter before anything is sent, so a fast reply can't be missed
+    def _expect(self, address, kind, timeout, replies):
+        waiter = _Waiter((address, kind), replies)
+        with self._lock:
+            self._waiting[waiter.key].append(waiter)
+            self._sequence += 1
+            heapq.heappush(self._timers, (time.monotonic() + timeout, self._sequence, waiter))
+            is_first = self._timers[0][2] is waiter
+        if is_first:
+            self._wake()
+        return waiter
+
+    def _cancel(self, waiter):
+        with self._lock:
+            self._remove_waiter(waiter)
+        self._finish(waiter, None)
+
+    # Must hold the lock
+    def _remove_waiter(self, waiter):
+        waiters = self._waiting.get(waiter.key)
+        if waiters is not None:
+            try:
+                waiters.remove(waiter)
+            except ValueError:
+                pass
+            if not waiters:
+                del self._waiting[waiter.key]
+
+    def _finish(self, waiter, data):
+        if not waiter.done:
+            waiter.done = True
+            waiter.data = data
+            waiter.event.set()
+
+    def _socket_index(self, address):
+        return hash(address) % len(self._sockets)
+
+    def _wake(self):
+        try:
+            self._wakeup_write.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # It's already going to wake up
+
+    def _run(self):
+        receivebuffer = memoryview(bytearray(RECEIVE_BUFFER_SIZE))
+        while self._running:
+            with self._lock:
+                timeout = None
+                if self._timers:
+                    timeout = max(0.0, self._timers[0][0] - time.monotonic())
+            for key, mask in self._selector.select(timeout):
+                if key.data is None:
+                    try:
+                        self._wakeup_read.recv(4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._receive(key.data, receivebuffer)
+            self._expire()
+
+    # Reads every datagram waiting on the socket and hands them out
+    def _receive(self, s, receivebuffer):
+        while True:
+            try:
+                length, address = s.recvfrom_into(receivebuffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # Things like ICMP port unreachable, the request just times out
+            decodeddata = net.huffman.decode(receivebuffer[:length])
+            kind = KIND_QUERY
+            if decodeddata and RCON_HEADER_MIN <= decodeddata[0] <= RCON_HEADER_MAX:
+                kind = KIND_RCON
+            key = (address[:2], kind)
+            with self._lock:
+                waiter = self._take_waiter(key, decodeddata[0] if decodeddata else None)
+                if waiter is None:
+                    callback = self._subscribers.get(key)
+            if waiter is not None:
+                self._finish(waiter, decodeddata)
+            elif callback is not None:
+                try:
+                    callback(decodeddata)
+                except Exception as e:
+                    print("Datagram subscriber for", key, "failed:", e)
+
+    # Must hold the lock, removes and returns the first waiter on the key that
+    # takes a reply with the header, or None if there isn't one
+    def _take_waiter(self, key, header):
+        waiters = self._waiting.get(key)
+        if not waiters:
+            return None
+        for waiter in waiters:
+            if waiter.replies is None or header in waiter.replies:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiting[key]
+                return waiter
+        return None
+
+    # Times out every waiter whose deadline has passed, and throws away the
+    # timers of the ones that already got their reply
+    def _expire(self):
+        expired = []
+        now = time.monotonic()
+        with self._lock:
+            while self._timers and (self._timers[0][0] <= now or self._timers[0][2].done):
+                deadline, sequence, waiter = heapq.heappop(self._timers)
+                if not waiter.done:
+                    self._remove_waiter(waiter)
+                    expired.append(waiter)
+        for waiter in expired:
+            self._finish(waiter, None)
+
+
+__transport = None
+__transport_lock = threading.Lock()
+
+
+# Returns the transport everything shares, it's made the first time it's needed
+def get_transport():
+    global __transport
+    with __transport_lock:
+        if __transport is None:
+            __transport = UDPTransport()
+        return __transport
+
+
+# Turns an (ip or hostname, port) into the numeric address replies come from
+def resolve(ip, port):
+    return socket.gethostbyname(ip), port